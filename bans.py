@@ -0,0 +1,47 @@
+import logging
+
+
+class BanService:
+    """In-memory set of banned users kept in sync with the bans table.
+
+    load() reads the full set once; refresh() applies ban_log entries past
+    the last seen id, so bans made by another process show up without a
+    query per check. ban()/unban() update the set immediately.
+    """
+
+    def __init__(self):
+        self.banned = set()
+        self.watermark = 0  # Last ban_log id applied
+
+    def is_banned(self, user_id):
+        return user_id in self.banned
+
+    def mark(self, user_id, banned=True):
+        """Apply a ban already written to the DB."""
+        if banned:
+            self.banned.add(user_id)
+        else:
+            self.banned.discard(user_id)
+
+    # ================= PERSISTENCE =================
+
+    def load(self, store):
+        self.banned, self.watermark = store.load_bans()
+
+    def refresh(self, store):
+        try:
+            for log_id, user_id, banned in store.ban_changes(self.watermark):
+                self.mark(user_id, banned)
+                self.watermark = log_id
+        except Exception as e:
+            logging.error(f"Ban refresh error: {e}")
+
+    def ban(self, store, user_id, reason=""):
+        """Ban a user; returns False if they were already banned."""
+        created = store.ban(user_id, reason)
+        self.mark(user_id)
+        return created
+
+    def unban(self, store, user_id):
+        store.unban(user_id)
+        self.mark(user_id, banned=False)
@@ -0,0 +1,464 @@
+"""Load-testing harness for the bot.
+
+Drives the real dispatcher from main.py with synthetic users against an
+in-process fake Bot API server and reports match latency, relay throughput
+and DB queries per action.
+
+    python bench.py --users 2000
+    BENCH_DATABASE_URL=postgresql://localhost/chatogram_bench python bench.py --users 2000
+
+Without BENCH_DATABASE_URL the bot runs on the in-memory store (memory://),
+which isolates handler and dispatch cost; "db q/act" then counts store calls.
+BENCH_DATABASE_URL must point to a scratch database: the bot's tables are
+dropped and recreated on every run. Set RELAY_FILTER=on to include the relay
+filter in the chat phase.
+
+Cold start (importing main plus create_app) is reported on every run;
+--max-startup-ms turns it into a pass/fail check, which tests/test_startup.py
+runs against its budget.
+
+--stress N ends the run with N random find/next/stop/reconnect/block updates
+fired concurrently at the same users, then fails if any pairing is left
+inconsistent (one-sided, self-paired, or chatting while still queued):
+
+    python bench.py --users 500 --stress 20000 --concurrency 2000
+
+--batch-ms N runs the bot with MATCH_BATCH_MS=N, so finds are paired by the
+batch matcher; the find phase then includes waiting for ticks. The cost of
+one tick against pool size can be measured on its own:
+
+    python bench.py --matcher
+
+The relay filter alone can be measured without a database; it fails if
+any clean or lookalike sample (dates, scores, ids) is caught:
+
+    python bench.py --relay-filter
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import sys
+import time
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMARK"
+BENCH_ADMIN_ID = 1
+
+# Tables are recreated by storage.setup() when main starts
+BENCH_RESET = """
+DROP TABLE IF EXISTS users, stats_rollup, daily_active, matches, chat_events,
+    referral_tiers, reports, bans, ban_log, payments, broadcasts, schema_version CASCADE;
+"""
+
+# ================= FAKE BOT API =================
+
+class FakeBotAPI:
+    """Minimal in-process Bot API: answers every method and records traffic."""
+
+    def __init__(self):
+        self.calls = {}          # {method: count}
+        self.matched_at = {}     # {chat_id: perf_counter of "Match found"}
+        self.last_text = {}      # {chat_id: text of the last message sent there}
+        self.message_ids = itertools.count(1)
+        self.runner = None
+        self.url = None
+
+    def _message(self, chat_id, text=None):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text or "",
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        chat_id = int(data.get("chat_id", 0) or 0)
+
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Chatogram", "username": "chatogram_bench_bot"}
+        elif method in ("sendMessage", "sendInvoice", "sendDocument"):
+            text = data.get("text", "")
+            self.last_text[chat_id] = text
+            if text.startswith("✅ Match found!"):
+                self.matched_at.setdefault(chat_id, time.perf_counter())
+            result = self._message(chat_id, text)
+        elif method == "getMyCommands":
+            result = []
+        elif method == "copyMessage":
+            result = {"message_id": next(self.message_ids)}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(self.runner, sock).start()
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+# ================= SYNTHETIC USERS =================
+
+_update_ids = itertools.count(1)
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def message_update(uid, text):
+    from aiogram import types
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": _user(uid),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update.to_object({"update_id": next(_update_ids), "message": message})
+
+
+def callback_update(uid, data):
+    from aiogram import types
+    return types.Update.to_object({
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": next(_update_ids),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "text": "🏷 Select your interests:",
+            },
+        },
+    })
+
+STRESS_ACTIONS = ["🔍 Find Chat", "🔍 Find Chat", "➡ Next", "/next", "⛔ Stop", "/stop", "🔁 Reconnect", "🚫 Block"]
+
+async def settle(main, leftover, timeout=10):
+    """Batch mode: wait for the matcher to drain the queue."""
+    deadline = time.perf_counter() + timeout
+    while len(main.waiting_queue) > leftover and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+# ================= REPORTING =================
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def db_query_count():
+    import metrics
+    return sum(series[2] for series in metrics.DB_QUERY_LATENCY.series.values())
+
+
+def pairing_errors(main):
+    """Chat/queue states that no sequence of handlers should produce."""
+    errors = []
+    for uid, partner in main.active_chats.items():
+        if partner == uid:
+            errors.append(f"{uid} is paired with itself")
+        elif main.active_chats.get(partner) != uid:
+            errors.append(f"{uid} -> {partner} but {partner} -> {main.active_chats.get(partner)}")
+        if uid in main.waiting_queue:
+            errors.append(f"{uid} is chatting and waiting")
+    return errors
+
+
+class Phase:
+    def __init__(self, name, api):
+        self.name = name
+        self.api = api
+        self.actions = 0
+
+    def __enter__(self):
+        self.queries = db_query_count()
+        self.api_calls = self.api.total_calls()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.queries = db_query_count() - self.queries
+        self.api_calls = self.api.total_calls() - self.api_calls
+
+    def row(self):
+        per_action = self.queries / self.actions if self.actions else 0
+        api_per_action = self.api_calls / self.actions if self.actions else 0
+        rate = self.actions / self.elapsed if self.elapsed else 0
+        return (f"{self.name:<10} {self.actions:>8} {self.elapsed:>9.2f}s {rate:>10.0f}/s "
+                f"{per_action:>10.1f} {api_per_action:>10.1f}")
+
+# ================= SCENARIO =================
+
+async def run(args):
+    api = FakeBotAPI()
+    await api.start()
+
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+    os.environ.setdefault("ADMIN_ID", str(BENCH_ADMIN_ID))
+    if args.batch_ms:
+        os.environ["MATCH_BATCH_MS"] = str(args.batch_ms)
+
+    if args.database_url != "memory://":
+        import psycopg2
+        setup = psycopg2.connect(args.database_url)
+        setup.autocommit = True
+        setup.cursor().execute(BENCH_RESET)
+        setup.close()
+
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    await main.create_app()
+    cold_start = (imported - started, time.perf_counter() - imported)
+    from aiogram import Bot, Dispatcher
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    matching = asyncio.create_task(main.matching_task()) if main.batch_matcher else None
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(update):
+        async with semaphore:
+            await main.dp.process_updates([update])
+
+    async def feed_all(updates):
+        await asyncio.gather(*(feed(u) for u in updates))
+
+    users = list(range(1_000_000, 1_000_000 + args.users))
+    phases = []
+
+    # Registration and onboarding
+    with Phase("start", api) as phase:
+        await feed_all(message_update(uid, "/start") for uid in users)
+        for step in ("25", "Male", "Berlin", "Germany"):
+            await feed_all(message_update(uid, step) for uid in users)
+        await feed_all(callback_update(uid, "interests_done") for uid in users)
+        phase.actions = len(users)
+    phases.append(phase)
+
+    # Matching: first half waits in the queue, second half finds them
+    find_pressed = {}
+    with Phase("find", api) as phase:
+        for half in (users[::2], users[1::2]):
+            for uid in half:
+                find_pressed[uid] = time.perf_counter()
+            await feed_all(message_update(uid, "🔍 Find Chat") for uid in half)
+        if matching:
+            await settle(main, len(users) % 2)
+        phase.actions = len(users)
+    phases.append(phase)
+
+    latencies = [
+        api.matched_at[uid] - find_pressed[uid]
+        for uid in users if uid in api.matched_at and uid in find_pressed
+    ]
+
+    # Relay: everyone in a chat sends a burst of messages
+    chatting = [uid for uid in users if uid in main.active_chats]
+    with Phase("chat", api) as phase:
+        for n in range(args.messages):
+            await feed_all(message_update(uid, f"hello {n}") for uid in chatting)
+        phase.actions = len(chatting) * args.messages
+    phases.append(phase)
+    relayed = phase.actions / phase.elapsed if phase.elapsed else 0
+
+    # Next: one side of every chat skips to a new partner
+    skippers = [uid for uid in users if main.active_chats.get(uid, 0) > uid]
+    with Phase("next", api) as phase:
+        await feed_all(message_update(uid, "➡ Next") for uid in skippers)
+        if matching:
+            await settle(main, len(users) % 2)
+        phase.actions = len(skippers)
+    phases.append(phase)
+
+    # Stop: end every chat and cancel every search
+    with Phase("stop", api) as phase:
+        await feed_all(message_update(uid, "/stop") for uid in users)
+        phase.actions = len(users)
+    phases.append(phase)
+
+    # Stress: random actions racing on the same users
+    errors = []
+    if args.stress:
+        rng = random.Random(args.seed)
+        with Phase("stress", api) as phase:
+            await feed_all(message_update(rng.choice(users), rng.choice(STRESS_ACTIONS)) for _ in range(args.stress))
+            phase.actions = args.stress
+        phases.append(phase)
+        errors = pairing_errors(main)
+
+    if matching:
+        matching.cancel()
+    for task in list(main.scheduled_timers):
+        task.cancel()
+    await (await main.bot.get_session()).close()
+    await api.stop()
+
+    print(f"\nusers={args.users} messages/user={args.messages} concurrency={args.concurrency}")
+    print(f"cold start: import={cold_start[0] * 1000:.0f}ms create_app={cold_start[1] * 1000:.0f}ms\n")
+    print(f"{'phase':<10} {'actions':>8} {'elapsed':>10} {'rate':>12} {'db q/act':>10} {'api/act':>10}")
+    for phase in phases:
+        print(phase.row())
+    print(f"\nmatches:        {len(latencies)} users notified")
+    print(f"match latency:  p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms")
+    print(f"relay:          {relayed:.0f} msg/s")
+    if args.stress:
+        print(f"pairings:       {len(main.active_chats) // 2} chats, {len(main.waiting_queue)} waiting, "
+              f"{len(errors)} inconsistent")
+        for error in errors[:10]:
+            print(f"  {error}")
+
+    if errors:
+        sys.exit(f"stress left {len(errors)} inconsistent pairings")
+    startup_ms = sum(cold_start) * 1000
+    if args.max_startup_ms is not None and startup_ms > args.max_startup_ms:
+        sys.exit(f"cold start {startup_ms:.0f}ms exceeds --max-startup-ms {args.max_startup_ms}")
+
+
+# ================= RELAY FILTER =================
+
+FILTER_WORDS = ["idiot", "stupid", "loser", "scam", "send nudes", "bitcoin", "cashapp", "venmo"]
+FILTER_SAMPLES = {
+    "clean": [
+        "hey, how are you?",
+        "I'm from Berlin, studying computer science. What about you?",
+        "haha same, I love hiking and old movies",
+        "what kind of music do you listen to? " * 4,
+    ],
+    # Digits that must not be taken for phone or card numbers
+    "lookalike": [
+        "see you 2024-01-15 10:30",
+        "I scored 100 200 300 400 points",
+        "my id is 123456789",
+    ],
+    "matching": [
+        "you are such an idiot",
+        "check this out https://example.com/promo",
+        "text me on +49 151 2345 6789",
+        "my card is 4111 1111 1111 1111, send it back via cashapp",
+    ],
+}
+
+
+def bench_relay_filter(args):
+    import relayfilter
+    relay_filter = relayfilter.RelayFilter(FILTER_WORDS)
+
+    print(f"\nrelay filter: {len(FILTER_WORDS)} words, {args.filter_iterations} iterations per message\n")
+    print(f"{'messages':<10} {'per message':>12}")
+    for name, samples in FILTER_SAMPLES.items():
+        if name != "matching":
+            caught = [text for text in samples if relay_filter.check(text)[0]]
+            if caught:
+                sys.exit(f"relay filter caught {name} messages: {caught}")
+        start = time.perf_counter()
+        for _ in range(args.filter_iterations):
+            for text in samples:
+                relay_filter.check(text)
+        elapsed = time.perf_counter() - start
+        per_message = elapsed / (args.filter_iterations * len(samples))
+        print(f"{name:<10} {per_message * 1e6:>10.1f}us")
+
+
+# ================= BATCH MATCHER =================
+
+def bench_matcher(args):
+    import matcher
+    rng = random.Random(args.seed)
+    cities = [f"city{n}" for n in range(20)]
+    interests = ["Music", "Movies", "Gaming", "Sports", "Travel", "Books", "Tech", "Art"]
+    modes = [{}, {"want_gender": "Male", "strict": True}, {"want_gender": "Female", "strict": True},
+             {"want_interests": True, "strict": True}, {"want_city": True, "strict": True}]
+
+    async def solve(pool, standing):
+        """Solve one tick; also returns the longest the event loop was blocked."""
+        stall, last, solving = 0.0, time.perf_counter(), True
+
+        async def probe():
+            nonlocal stall, last
+            while solving:
+                await asyncio.sleep(0)
+                now = time.perf_counter()
+                stall, last = max(stall, now - last), now
+
+        probe_task = asyncio.create_task(probe())
+        pairs = await pool.solve(standing)
+        solving = False
+        await probe_task
+        return pairs, stall
+
+    print(f"\nbatch matcher: {args.matcher_ticks} ticks per pool size, at most {matcher.MAX_POOL} considered\n")
+    print(f"{'waiters':<10} {'tick':>10} {'stall':>10} {'pairs':>8}")
+    for size in (100, 500, 1000, 2000, 5000):
+        pool = matcher.BatchMatcher(lambda a, b: False, lambda uid: True)
+        standing = {}
+        for uid in range(size):
+            pool.add(matcher.Waiter(
+                uid, rng.choice(("Male", "Female")), rng.choice(cities),
+                ", ".join(rng.sample(interests, 3)), **rng.choice(modes),
+            ))
+            standing[uid] = (rng.choice((0, 0, 0, 1, 4)), rng.randint(-12, 30))
+        start = time.perf_counter()
+        stall = 0.0
+        for _ in range(args.matcher_ticks):
+            pairs, tick_stall = asyncio.run(solve(pool, standing))
+            stall = max(stall, tick_stall)
+        elapsed = (time.perf_counter() - start) / args.matcher_ticks
+        print(f"{size:<10} {elapsed * 1000:>8.1f}ms {stall * 1000:>8.1f}ms {len(pairs):>8}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chatogram load test")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user in the chat phase")
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at once")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "memory://"))
+    parser.add_argument("--stress", type=int, default=0, help="random concurrent updates to race at the end")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-ms", type=int, default=0, help="run with the batch matcher at this tick")
+    parser.add_argument("--matcher", action="store_true", help="only measure batch matcher tick cost")
+    parser.add_argument("--matcher-ticks", type=int, default=5)
+    parser.add_argument("--max-startup-ms", type=float, help="fail if import + create_app takes longer")
+    parser.add_argument("--relay-filter", action="store_true", help="only measure the relay filter")
+    parser.add_argument("--filter-iterations", type=int, default=20000)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.relay_filter:
+        bench_relay_filter(args)
+    elif args.matcher:
+        bench_matcher(args)
+    else:
+        asyncio.run(run(args))
@@ -0,0 +1,93 @@
+import math
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(x):
+    """splitmix64 finalizer: spreads sequential user ids over 64 bits."""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    """Fixed-capacity bloom filter over integer ids (no false negatives)."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        h1 = _mix(item)
+        h2 = _mix(h1) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class BlockIndex:
+    """In-memory block lists with a reverse "blocked-by" index.
+
+    Entries are loaded lazily per user through `loader(uid)`, which returns
+    (users uid blocked, users who blocked uid). Once a user is loaded, both
+    directions of any pair involving them are checked in memory. Users who
+    block more than `heavy_threshold` people are stored as a bloom filter;
+    a false positive only means a candidate is skipped.
+    """
+
+    def __init__(self, loader, heavy_threshold=256):
+        self.loader = loader
+        self.heavy_threshold = heavy_threshold
+        self.blocked = {}     # {uid: set or BloomFilter of users uid blocked}
+        self.blocked_by = {}  # {uid: set of users who blocked uid}
+
+    def _compact(self, ids):
+        ids = set(ids)
+        if len(ids) <= self.heavy_threshold:
+            return ids
+        bloom = BloomFilter(capacity=len(ids) * 2)
+        for i in ids:
+            bloom.add(i)
+        return bloom
+
+    def _ensure(self, uid):
+        if uid not in self.blocked:
+            blocked, blocked_by = self.loader(uid)
+            self.blocked[uid] = self._compact(blocked)
+            self.blocked_by[uid] = set(blocked_by)
+
+    def blocks_either(self, uid, other):
+        """True if uid blocked other or other blocked uid."""
+        self._ensure(uid)
+        return other in self.blocked[uid] or other in self.blocked_by[uid]
+
+    def add(self, blocker, blocked):
+        """Record a new block already persisted to the DB."""
+        entry = self.blocked.get(blocker)
+        if entry is not None:
+            if isinstance(entry, BloomFilter) and len(entry) >= entry.capacity:
+                # Full filter: reload from the DB on next use
+                del self.blocked[blocker]
+                self.blocked_by.pop(blocker, None)
+            else:
+                entry.add(blocked)
+                if isinstance(entry, set) and len(entry) > self.heavy_threshold:
+                    self.blocked[blocker] = self._compact(entry)
+
+        reverse = self.blocked_by.get(blocked)
+        if reverse is not None:
+            reverse.add(blocker)
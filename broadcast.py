@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from aiogram.utils.exceptions import RetryAfter
+
+import delivery
+import metrics
+
+SENT = "sent"
+FAILED = "failed"
+UNREACHABLE = delivery.UNREACHABLE
+
+MAX_RETRIES = 3
+
+BROADCAST_DELIVERIES = metrics.Counter(
+    "chatogram_broadcast_deliveries_total", "Broadcast messages by outcome", labels=("result",)
+)
+
+
+class RateLimiter:
+    """Spaces acquisitions 1/rate seconds apart, however many tasks wait."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_at = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        at = max(now, self.next_at)
+        self.next_at = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+class Broadcaster:
+    """Delivers the store's unfinished broadcast to every reachable user.
+
+    Recipients are read in keyset pages of `chunk_size` ids and each page is
+    sent by up to `concurrency` tasks through one rate limiter, so memory is
+    bounded by the page however many users there are. Progress is saved
+    after every page: a restart resumes after the last saved id, resending
+    at most one page. Unreachable users are flagged by the bot's delivery
+    tracker, which sees every failed send, and skipped from then on.
+    """
+
+    def __init__(self, send, rate=25, concurrency=10, chunk_size=500):
+        self.send = send  # async send(user_id, text)
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+
+    async def _deliver(self, semaphore, user_id, text):
+        async with semaphore:
+            for _ in range(MAX_RETRIES):
+                await self.limiter.wait()
+                try:
+                    await self.send(user_id, text)
+                    return SENT
+                except RetryAfter as e:
+                    await asyncio.sleep(e.timeout)
+                except delivery.UNREACHABLE_ERRORS:
+                    return UNREACHABLE
+                except Exception as e:
+                    logging.info(f"Broadcast to {user_id} failed: {e}")
+                    return FAILED
+            return FAILED
+
+    async def run(self, store):
+        """Send until the active broadcast is finished or cancelled.
+
+        Returns (broadcast_id, sent, failed) for a finished broadcast, or
+        None if there was none or it was cancelled meanwhile.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            # Re-read every page so /broadcast cancel takes effect
+            active = store.active_broadcast()
+            if active is None:
+                return None
+            broadcast_id, text, last_user_id, sent, failed = active
+
+            recipients = store.broadcast_recipients(last_user_id, self.chunk_size)
+            if not recipients:
+                store.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, finished=True)
+                return broadcast_id, sent, failed
+
+            results = await asyncio.gather(*(self._deliver(semaphore, uid, text) for uid in recipients))
+            for result in results:
+                BROADCAST_DELIVERIES.inc(result)
+            sent += results.count(SENT)
+            failed += len(results) - results.count(SENT)
+            store.save_broadcast_progress(broadcast_id, recipients[-1], sent, failed)
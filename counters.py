@@ -0,0 +1,87 @@
+import logging
+from datetime import datetime
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+def today():
+    # Local time, like every other timestamp the bot writes
+    return datetime.now().date()
+
+
+class Counters:
+    """Daily and all-time event counters kept in memory and rolled up to storage.
+
+    Handlers call incr()/mark_active() as events happen; flush() writes the
+    accumulated deltas in one batch so reads never touch the DB.
+    """
+
+    def __init__(self):
+        self.day = today()
+        self.daily = {}          # {name: value} for self.day
+        self.totals = {}         # {name: value} all-time
+        self.pending = {}        # {(day, name): delta} not yet flushed
+        self.active = set()      # user_ids seen on self.day
+        self.pending_active = []  # (day, user_id) not yet flushed
+
+    def _roll(self):
+        current = today()
+        if current != self.day:
+            self.day = current
+            self.daily = {}
+            self.active = set()
+
+    def incr(self, name, amount=1):
+        self._roll()
+        self.daily[name] = self.daily.get(name, 0) + amount
+        self.totals[name] = self.totals.get(name, 0) + amount
+        key = (self.day, name)
+        self.pending[key] = self.pending.get(key, 0) + amount
+
+    def mark_active(self, user_id):
+        self._roll()
+        if user_id not in self.active:
+            self.active.add(user_id)
+            self.pending_active.append((self.day, user_id))
+
+    def get(self, name):
+        self._roll()
+        return self.daily.get(name, 0), self.totals.get(name, 0)
+
+    def active_today(self):
+        self._roll()
+        return len(self.active)
+
+    # ================= PERSISTENCE =================
+
+    def load(self, store):
+        """Load totals and today's window (the store backfills on first run)."""
+        self.day = today()
+        self.totals, self.daily, self.active = store.load_counters(self.day)
+
+    def flush(self, store):
+        pending, self.pending = self.pending, {}
+        pending_active, self.pending_active = self.pending_active, []
+        if not pending and not pending_active:
+            return
+        try:
+            store.add_counters(pending, pending_active)
+        except Exception as e:
+            logging.error(f"Counters flush error: {e}")
+            # Keep the deltas for the next flush
+            for key, delta in pending.items():
+                self.pending[key] = self.pending.get(key, 0) + delta
+            self.pending_active.extend(pending_active)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Marks the sender of every update as active today."""
+
+    def __init__(self, counters):
+        super().__init__()
+        self.counters = counters
+
+    async def on_pre_process_update(self, update, data):
+        event = update.message or update.callback_query or update.pre_checkout_query
+        if event and event.from_user:
+            self.counters.mark_active(event.from_user.id)
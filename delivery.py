@@ -0,0 +1,90 @@
+import logging
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, RetryAfter, UserDeactivated
+
+import metrics
+
+UNREACHABLE = "unreachable"
+RATE_LIMITED = "rate_limited"
+TRANSIENT = "transient"
+
+# The user blocked the bot, deleted their account, or never started it
+UNREACHABLE_ERRORS = (BotBlocked, UserDeactivated, ChatNotFound)
+
+DELIVERY_FAILURES = metrics.Counter(
+    "chatogram_delivery_failures_total", "Failed sends to users by kind", labels=("kind",)
+)
+
+
+def classify(error):
+    if isinstance(error, UNREACHABLE_ERRORS):
+        return UNREACHABLE
+    if isinstance(error, RetryAfter):
+        return RATE_LIMITED
+    return TRANSIENT
+
+
+class DeliveryTracker:
+    """Users the bot can no longer message, kept in sync with users.unreachable.
+
+    failed() classifies every Bot API error for a chat; unreachable users
+    are remembered here and flagged in the DB by flush(). load() reads the
+    flags left by earlier runs, so a user becomes reachable again as soon
+    as they send the bot anything, whenever they were flagged. Only
+    flagged users are held in memory.
+    """
+
+    def __init__(self):
+        self.unreachable = set()
+        self.pending = {}  # {user_id: unreachable} not yet flushed
+
+    def load(self, store):
+        self.unreachable = store.unreachable_users()
+
+    def is_unreachable(self, user_id):
+        return user_id in self.unreachable
+
+    def mark(self, user_id, unreachable=True):
+        if unreachable:
+            self.unreachable.add(user_id)
+        else:
+            self.unreachable.discard(user_id)
+        self.pending[user_id] = unreachable
+
+    def failed(self, user_id, error):
+        """Record a failed send to user_id; returns its kind."""
+        kind = classify(error)
+        DELIVERY_FAILURES.inc(kind)
+        if kind == UNREACHABLE and user_id not in self.unreachable:
+            self.mark(user_id)
+        return kind
+
+    def flush(self, store):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            flagged = [uid for uid, unreachable in pending.items() if unreachable]
+            cleared = [uid for uid, unreachable in pending.items() if not unreachable]
+            if flagged:
+                store.mark_unreachable(flagged)
+            if cleared:
+                store.mark_reachable(cleared)
+        except Exception as e:
+            logging.error(f"Delivery flush error: {e}")
+            for uid, unreachable in pending.items():
+                self.pending.setdefault(uid, unreachable)
+
+
+class DeliveryMiddleware(BaseMiddleware):
+    """Clears the unreachable flag of anyone who messages the bot."""
+
+    def __init__(self, tracker):
+        super().__init__()
+        self.tracker = tracker
+
+    async def on_pre_process_update(self, update, data):
+        event = update.message or update.callback_query or update.pre_checkout_query
+        if event and event.from_user and self.tracker.is_unreachable(event.from_user.id):
+            self.tracker.mark(event.from_user.id, unreachable=False)
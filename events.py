@@ -0,0 +1,56 @@
+import logging
+from datetime import datetime
+
+import metrics
+
+MAX_BUFFERED = 50000  # Events dropped beyond this if the DB is unreachable
+
+EVENTS_DROPPED = metrics.Counter("chatogram_events_dropped_total", "Events dropped on buffer overflow")
+
+
+class EventLog:
+    """In-memory buffer of chat events written in batches off the hot path."""
+
+    def __init__(self):
+        self.events = []      # (event, user_id, partner_id, duration, created_at)
+        self.matches = []     # (user1, user2, matched_at, ended_at, duration, end_reason)
+
+    def _full(self):
+        if len(self.events) + len(self.matches) >= MAX_BUFFERED:
+            EVENTS_DROPPED.inc()
+            return True
+        return False
+
+    def record(self, event, user_id, partner_id=None, duration=None):
+        """Buffer a match/end/skip/report/block event."""
+        if not self._full():
+            self.events.append((event, user_id, partner_id, duration, datetime.now()))
+
+    def record_match(self, user1, user2, started, reason="end"):
+        """Buffer a finished chat for the matches history."""
+        if started is None or self._full():
+            return
+        ended = datetime.now()
+        self.matches.append((
+            user1, user2, int(started.timestamp()), int(ended.timestamp()),
+            int((ended - started).total_seconds()), reason
+        ))
+
+    # ================= PERSISTENCE =================
+
+    def flush(self, store):
+        events, self.events = self.events, []
+        if events:
+            try:
+                store.add_chat_events(events)
+            except Exception as e:
+                logging.error(f"Event log flush error: {e}")
+                self.events = events + self.events  # Retry on the next tick
+
+        matches, self.matches = self.matches, []
+        if matches:
+            try:
+                store.add_matches(matches)
+            except Exception as e:
+                logging.error(f"Matches flush error: {e}")
+                self.matches = matches + self.matches
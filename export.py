@@ -0,0 +1,40 @@
+import csv
+import gzip
+import io
+import json
+import tempfile
+
+FORMATS = ("csv", "jsonl")
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+
+
+def write_export(store, name, fmt):
+    """Stream table `name` into a gzip-compressed CSV or JSONL file.
+
+    Rows go straight from store.export_rows() through the compressor into
+    a temp file, so memory stays flat for any table size. Blocking: run it
+    in a thread.
+    Returns (file positioned at 0, row count); the caller closes the file.
+    """
+    # A real temp file, not spooled: aiogram's InputFile needs an io.IOBase
+    out = tempfile.TemporaryFile()
+    rows = store.export_rows(name)
+    columns = next(rows)
+    count = 0
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                text.write(json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False))
+                text.write("\n")
+                count += 1
+        text.flush()
+        text.detach()
+    out.seek(0)
+    return out, count
@@ -0,0 +1,30 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class StripedLocks:
+    """Per-user asyncio locks from a fixed pool.
+
+    A user maps to stripe `user_id % stripes`, so memory stays constant no
+    matter how many users are seen; two users sharing a stripe only
+    serialise each other. hold() takes the stripes of every given user in
+    ascending order, which keeps pair operations from deadlocking. Locks
+    are not reentrant: release before calling anything that takes them.
+    """
+
+    def __init__(self, stripes=1024):
+        self.locks = [asyncio.Lock() for _ in range(stripes)]
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        stripes = sorted({uid % len(self.locks) for uid in user_ids})
+        acquired = []
+        try:
+            for stripe in stripes:
+                lock = self.locks[stripe]
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
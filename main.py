@@ -1,10 +1,11 @@
 import logging
 import os
-import psycopg2
 import random
 import asyncio
+import time
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Dispatcher, executor, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
@@ -12,44 +13,148 @@ from aiogram.types import (
 )
 from dotenv import load_dotenv
 
+import bans
+import broadcast
+import counters
+import delivery
+import events
+import export
+import matcher
+import metrics
+import moderation
+import presence
+import profilecards
+import querybudget
+import recentpartners
+import relayfilter
+import storage
+import ttlstate
+from blockindex import BlockIndex
+from locks import StripedLocks
+from router import Router
+
 load_dotenv()
 
 # ================= CONFIG ========================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
-DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_URL = os.getenv("DATABASE_URL")  # Postgres DSN, or memory:// for an in-process store
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Alternative Bot API server (local server, benchmarks)
+METRICS_PORT = os.getenv("METRICS_PORT")  # Prometheus /metrics endpoint, disabled if unset
+COUNTERS_FLUSH_SECONDS = int(os.getenv("COUNTERS_FLUSH_SECONDS", "30"))
+EVENTS_FLUSH_SECONDS = int(os.getenv("EVENTS_FLUSH_SECONDS", "5"))
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "300"))
+PRESENCE_FLUSH_SECONDS = int(os.getenv("PRESENCE_FLUSH_SECONDS", "60"))
+MODERATION_FLUSH_SECONDS = int(os.getenv("MODERATION_FLUSH_SECONDS", "5"))
+AUTO_BAN_REPORTS = int(os.getenv("AUTO_BAN_REPORTS", "3"))  # Distinct reporters within the window
+AUTO_BAN_WINDOW_HOURS = int(os.getenv("AUTO_BAN_WINDOW_HOURS", "24"))
+BAN_REFRESH_SECONDS = int(os.getenv("BAN_REFRESH_SECONDS", "30"))
+STARTUP_RETRIES = int(os.getenv("STARTUP_RETRIES", "5"))  # Health check attempts before giving up
+MATCH_BATCH_MS = int(os.getenv("MATCH_BATCH_MS", "0"))  # Pair waiters in batches every N ms; 0 matches per request
+RECENT_PARTNER_WINDOW = int(os.getenv("RECENT_PARTNER_WINDOW", "3"))  # Last N partners find won't rematch; 0 disables
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # Broadcast messages per second, under Telegram's ~30/s
+BROADCAST_RETRY_SECONDS = int(os.getenv("BROADCAST_RETRY_SECONDS", "5"))  # First retry after a failed broadcast run
+BROADCAST_RETRY_MAX_SECONDS = int(os.getenv("BROADCAST_RETRY_MAX_SECONDS", "300"))
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", "900"))  # Abandoned edit/report/share flows expire after this
+ONBOARDING_TTL_SECONDS = int(os.getenv("ONBOARDING_TTL_SECONDS", "86400"))  # Idle time before registration is dropped
+STATE_SWEEP_SECONDS = int(os.getenv("STATE_SWEEP_SECONDS", "60"))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is required")
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is required")
 if not ADMIN_ID:
     raise ValueError("ADMIN_ID environment variable is required")
 
+if RECENT_PARTNER_WINDOW < 0:
+    raise ValueError("RECENT_PARTNER_WINDOW must be 0 or more")
+
 ADMIN_ID = int(ADMIN_ID)
 
 # Global States
-bot = Bot(token=BOT_TOKEN)
+bot = metrics.InstrumentedBot(
+    token=BOT_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+)
 dp = Dispatcher(bot)
+dp.middleware.setup(querybudget.QueryBudgetMiddleware())
+
+# All messages go through one O(1) front router instead of aiogram's filter chain
+router = Router()
+router.register(dp)
+
+event_counters = counters.Counters()  # Daily/all-time counters behind /stats
+dp.middleware.setup(counters.ActivityMiddleware(event_counters))
+
+event_log = events.EventLog()  # Buffered match/end/skip/report/block history
+metrics.Gauge("chatogram_events_buffered", "Events waiting to be flushed", lambda: len(event_log.events))
+
+user_presence = presence.Presence(ttl=PRESENCE_TTL_SECONDS)  # "Online" = recent activity
+dp.middleware.setup(presence.PresenceMiddleware(user_presence))
+
+# Users who blocked the bot: dropped from matching, skipped by broadcasts
+delivery_tracker = delivery.DeliveryTracker()
+dp.middleware.setup(delivery.DeliveryMiddleware(delivery_tracker))
+
+# Reports are acknowledged immediately and evaluated for auto-bans in the background
+moderation_queue = moderation.ModerationQueue(threshold=AUTO_BAN_REPORTS, window_hours=AUTO_BAN_WINDOW_HOURS)
+metrics.Gauge("chatogram_reports_pending", "Reports waiting for moderation", lambda: len(moderation_queue.pending))
 
-user_edit_state = {}    # For text input edits
-onboarding_state = {}   # For registration flow
+broadcaster = broadcast.Broadcaster(lambda uid, text: bot.send_message(uid, text), rate=BROADCAST_RATE)
+broadcast_job = None  # asyncio.Task delivering the active broadcast
+
+ban_service = bans.BanService()  # Banned user set, refreshed from ban_log
+
+relay_filter = relayfilter.from_env()  # Optional word/link/contact filter on relayed text
+
+# Multi-step flows: entries expire if the user walks away mid-flow
+user_edit_state = ttlstate.TTLState(STATE_TTL_SECONDS)  # For text input edits
+onboarding_state = ttlstate.TTLState(ONBOARDING_TTL_SECONDS)  # For registration flow: {user_id: {"step": ..., "age": ..., ...}}
+interest_state = ttlstate.TTLState(STATE_TTL_SECONDS)   # {user_id: [selected interests]} while editing interests
 active_chats = {}       # {user_id: partner_id} (Bidirectional)
 waiting_queue = set()   # Users waiting for random match
-report_state = {}       # {reporter_id: reported_id}
-share_profile_state = {}  # {user_id: "awaiting_confirmation"} - for /shareprofile flow
+report_state = ttlstate.TTLState(STATE_TTL_SECONDS)  # {reporter_id: reported_id}
+share_profile_state = ttlstate.TTLState(STATE_TTL_SECONDS)  # {user_id: "awaiting_confirmation"} - for /shareprofile flow
+flow_states = (user_edit_state, onboarding_state, interest_state, report_state, share_profile_state)
+
+block_index = BlockIndex(lambda uid: store.block_lists(uid))  # Mutual-block checks for matching
+profile_cards = profilecards.ProfileCards(lambda uid: store.get_profile(uid))  # Rendered once per profile change
 
 upsell_shown = set()      # {user_id} - Track upsells
 expiry_reminded = set()   # {user_id} - Track reminders
 safety_shown = set()      # {user_id} - Track safety notices
 
 chat_start_times = {}     # {user_id: datetime}
+last_partner = {}         # {user_id: partner_id} - for reconnect, DB fallback after restart
+recent_partners = recentpartners.RecentPartners(
+    RECENT_PARTNER_WINDOW, lambda uid, limit: store.recent_partners(uid, limit)
+)
+user_locks = StripedLocks()  # Held around any change to a user's chat or queue entry
+batch_matcher = matcher.BatchMatcher(
+    lambda a, b: block_index.blocks_either(a, b) or recent_partners.contains(a, b),
+    lambda uid: user_presence.is_online(uid),
+) if MATCH_BATCH_MS else None
+premium_until = {}        # {user_id: datetime | None} - refreshed by every premium change we make
 skip_history = {}         # {user_id: [timestamps]}
+scheduled_timers = set()  # {asyncio.Task} - pending queue timeouts
+notification_queue = asyncio.Queue()  # (user_id, text) sent by notification_worker
+
+metrics.Gauge("chatogram_waiting_queue_size", "Users waiting for a match", lambda: len(waiting_queue))
+metrics.Gauge("chatogram_active_chats", "Active chat pairs", lambda: len(active_chats) // 2)
+metrics.Gauge("chatogram_batch_pool_size", "Waiters in the batch matcher", lambda: len(batch_matcher or ()))
+metrics.Gauge("chatogram_scheduled_timers", "Pending scheduled timers", lambda: len(scheduled_timers))
+metrics.Gauge("chatogram_notifications_queued", "Queued user notifications", lambda: notification_queue.qsize())
+metrics.Gauge("chatogram_flow_states", "Users in a multi-step flow", lambda: sum(len(s) for s in flow_states))
 
 upsell_kb = ReplyKeyboardMarkup(resize_keyboard=True)
 upsell_kb.add("⭐ Buy Premium", "⬅ Back to Menu")
+UPSELL_TEXT = (
+    "⭐ *Unlock Premium Logic*\n\n"
+    "• Find by Gender (Man/Woman)\n"
+    "• Find by Interests & City\n"
+    "• See Partner Details\n"
+    "• No Ads & Priority Support"
+)
 
 # Predefined Interests for Selection
 AVAILABLE_INTERESTS = [
@@ -59,149 +164,203 @@ AVAILABLE_INTERESTS = [
 
 logging.basicConfig(level=logging.INFO)
 
-# ================= DB CONNECTION =====================
+# ================= STORAGE =====================
+
+store = None  # storage.Storage, opened by init_storage() at startup
+
+def init_storage():
+    """Open the configured backend, upgrade its schema and load cached state."""
+    global store
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL environment variable is required")
+    opened = storage.connect(DATABASE_URL)
+    opened.setup()
+    store = opened
 
-try:
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True
-    cur = conn.cursor()
-    
-    # Reputation Schema Check
     try:
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS reputation_score INTEGER DEFAULT 0")
+        event_counters.load(store)
     except Exception as e:
-        logging.error(f"DB Schema Update Error: {e}")
-
-    # Referral Schema Check
+        logging.error(f"Counters load error: {e}")
     try:
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referred_by BIGINT")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_completed BOOLEAN DEFAULT FALSE")
+        ban_service.load(store)
     except Exception as e:
-        logging.error(f"DB Schema Update Error (Referral): {e}")
-
-except Exception as e:
-    logging.error(f"Database connection failed: {e}")
-    exit(1)
+        logging.error(f"Ban list load error: {e}")
+    try:
+        delivery_tracker.load(store)
+    except Exception as e:
+        logging.error(f"Unreachable users load error: {e}")
+    return store
 
 # ================= HELPERS ===========================
 
 def update_reputation(user_id, delta):
     try:
-        cur.execute("UPDATE users SET reputation_score = reputation_score + %s WHERE user_id=%s", (delta, user_id))
+        store.update_reputation(user_id, delta)
     except Exception as e:
         logging.error(f"Reputation update error: {e}")
 
+async def counters_flush_task():
+    while True:
+        await asyncio.sleep(COUNTERS_FLUSH_SECONDS)
+        event_counters.flush(store)
+
+async def events_flush_task():
+    while True:
+        await asyncio.sleep(EVENTS_FLUSH_SECONDS)
+        event_log.flush(store)
+        delivery_tracker.flush(store)
+
+async def presence_flush_task():
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_SECONDS)
+        user_presence.flush(store)
+
+async def moderation_task():
+    while True:
+        await asyncio.sleep(MODERATION_FLUSH_SECONDS)
+        for uid in moderation_queue.flush(store):
+            ban_service.mark(uid)
+            await remove_banned_user(uid)
+            queue_notification(uid, "🚫 You have been banned due to multiple reports.")
+
+async def ban_refresh_task():
+    """Pick up bans made outside this process (dp.ban_user, manual SQL)."""
+    while True:
+        await asyncio.sleep(BAN_REFRESH_SECONDS)
+        ban_service.refresh(store)
+
+async def state_sweep_task():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_SECONDS)
+        for state in flow_states:
+            state.sweep()
+
+async def broadcast_task():
+    # run() resumes from the last saved page, so a failed run is simply retried
+    delay = BROADCAST_RETRY_SECONDS
+    while True:
+        try:
+            result = await broadcaster.run(store)
+            break
+        except Exception as e:
+            logging.error(f"Broadcast error, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BROADCAST_RETRY_MAX_SECONDS)
+    if result:
+        broadcast_id, sent, failed = result
+        queue_notification(ADMIN_ID, f"📣 Broadcast #{broadcast_id} finished: {sent} sent, {failed} failed.")
+
+def start_broadcast_job():
+    """Deliver the active broadcast, if any, unless already delivering."""
+    global broadcast_job
+    if broadcast_job is None or broadcast_job.done():
+        broadcast_job = asyncio.create_task(broadcast_task())
+
+def delivery_failed(method, data, error):
+    """Every failed Bot API request: unreachable users stop being matched."""
+    chat_id = str((data or {}).get("chat_id", ""))
+    if not chat_id.isdigit():
+        return  # Not a user's private chat
+    uid = int(chat_id)
+    if delivery_tracker.failed(uid, error) == delivery.UNREACHABLE:
+        waiting_queue.discard(uid)
+
+metrics.request_error_listeners.append(delivery_failed)
+
+async def remove_banned_user(uid):
+    """Take a newly banned user out of matching and any active chat."""
+    waiting_queue.discard(uid)
+    partner = active_chats.get(uid)
+    if partner is not None:
+        async with user_locks.hold(uid, partner):
+            if active_chats.get(uid) == partner:
+                await end_chat(uid, partner, notify_user1=False, reason="ban")
+
+async def matching_task():
+    while True:
+        await asyncio.sleep(MATCH_BATCH_MS / 1000)
+        try:
+            await match_waiters()
+        except Exception as e:
+            logging.error(f"Batch matching error: {e}")
+
+async def match_waiters():
+    """One batch matching tick: one standing query for the whole pool."""
+    batch_matcher.retain(waiting_queue)
+    if len(batch_matcher) < 2:
+        return
+    pairs = await batch_matcher.solve(store.get_standing(batch_matcher.waiters))
+    await asyncio.gather(*(connect_waiters(a, b) for a, b in pairs))
+
+async def connect_waiters(user1, user2):
+    async with user_locks.hold(user1, user2):
+        if user1 in waiting_queue and user2 in waiting_queue:
+            await connect_users(user1, user2)
+
 async def reputation_decay_task():
     while True:
         await asyncio.sleep(7 * 24 * 3600)  # 7 days
         try:
-            cur.execute("UPDATE users SET reputation_score = GREATEST(0, reputation_score - 1)")
+            store.decay_reputation()
         except Exception as e:
             logging.error(f"Reputation decay error: {e}")
 
-async def check_referral_reward(user_id):
-    """Check if user completed onboarding and reward referrer."""
+async def check_referral_reward(user_id, row=None):
+    """Check if user completed onboarding and reward referrer.
+
+    `row` is (storage.REFERRAL_CHECK_COLUMNS) when the caller already has
+    it; it lets us skip the statement for users with nothing to reward.
+    """
     try:
-        cur.execute("""
-            SELECT referred_by, referral_completed, age, gender, city, interests 
-            FROM users WHERE user_id=%s
-        """, (user_id,))
-        row = cur.fetchone()
-        
-        if not row: return
-        referred_by, completed, age, gender, city, interests = row
-        
-        # Conditions: Has referrer, not yet counted, and profile full
-        if not referred_by or completed:
-            return
-            
-        if not (age and gender and city and interests):
-            return
+        if row is not None:
+            referred_by, completed, age, gender, city, interests = row
+            # Conditions: Has referrer, not yet counted, and profile full
+            if not referred_by or completed:
+                return
+            if not (age and gender and city and interests):
+                return
 
-        # Mark as completed to prevent double counting
-        cur.execute("UPDATE users SET referral_completed=true WHERE user_id=%s", (user_id,))
-        
-        # Increment referrer count
-        cur.execute("""
-            UPDATE users 
-            SET referral_count = referral_count + 1 
-            WHERE user_id=%s 
-            RETURNING referral_count
-        """, (referred_by,))
-        
-        res = cur.fetchone()
+        res = store.complete_referral(user_id)
         if not res: return
-        count = res[0]
-        
-        # Reward Logic
-        reward = None
-        if count == 1: reward = timedelta(minutes=30)
-        elif count == 3: reward = timedelta(hours=3)
-        elif count == 5: reward = timedelta(days=1)
-        elif count == 10: reward = timedelta(days=3)
+        referrer_id, count, reward = res
+        event_counters.incr("referrals")
         
         if reward:
-            # Stack rewards
-            cur.execute("""
-                UPDATE users 
-                SET premium_until = GREATEST(COALESCE(premium_until, NOW()), NOW()) + %s 
-                WHERE user_id=%s
-            """, (reward, referred_by))
-            
-            try:
-                await bot.send_message(
-                    referred_by, 
-                    f"🎉 Referral Bonus! You invited {count} friends.\n⭐ Premium extended!"
-                )
-            except: pass
+            premium_until.pop(referrer_id, None)
+            queue_notification(referrer_id, f"🎉 Referral Bonus! You invited {count} friends.\n⭐ Premium extended!")
             
     except Exception as e:
         logging.error(f"Referral check error: {e}")
 
+def get_premium_until(user_id):
+    if user_id not in premium_until:
+        premium_until[user_id] = store.get_premium_until(user_id)
+    return premium_until[user_id]
+
 def is_premium(user_id):
     try:
-        cur.execute(
-            "SELECT premium_until FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        row = cur.fetchone()
-        return row and row[0] and row[0] > datetime.now()
+        until = get_premium_until(user_id)
+        return bool(until and until > datetime.now())
     except Exception:
         return False
 
-def get_blocked_users(user_id):
-    """Get list of blocked users for a given user_id, handles NULL safely."""
-    try:
-        cur.execute(
-            "SELECT blocked_users FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        row = cur.fetchone()
-        if row and row[0] is not None:
-            return row[0]
-        return []
-    except Exception:
-        return []
+def queue_notification(uid, text):
+    """Send a message from the background worker instead of the handler."""
+    notification_queue.put_nowait((uid, text))
 
-def check_and_auto_ban(user_id):
-    """Check report_count and auto-ban if threshold reached"""
-    try:
-        cur.execute(
-            "SELECT report_count FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        row = cur.fetchone()
-        # FIX: Explicit None check for safer handling
-        if row and row[0] is not None and row[0] >= 3:
-            cur.execute(
-                "UPDATE users SET banned=true WHERE user_id=%s",
-                (user_id,)
-            )
-            return True
-        return False
-    except Exception:
-        return False
+async def notification_worker():
+    while True:
+        uid, text = await notification_queue.get()
+        try:
+            await bot.send_message(uid, text)
+        except Exception as e:
+            logging.info(f"Notification to {uid} failed: {e}")
+
+def schedule_timer(coro):
+    task = asyncio.create_task(coro)
+    scheduled_timers.add(task)
+    task.add_done_callback(scheduled_timers.discard)
+    return task
 
 async def queue_timeout(uid):
     await asyncio.sleep(60)
@@ -212,24 +371,26 @@ async def queue_timeout(uid):
         except Exception:
             pass
 
-async def end_chat(user1, user2, notify_user1=True, notify_user2=True):
-    """Safely disconnect two users and notify them."""
+@metrics.timed
+async def end_chat(user1, user2, notify_user1=True, notify_user2=True, reason="end"):
+    """Safely disconnect two users and notify them.
+
+    `reason` is logged as the event type: end, skip, block, ban or error.
+    """
     
     # Reputation Reward: Chat duration > 3 minutes -> +1
     start_time = chat_start_times.pop(user1, None)
     _ = chat_start_times.pop(user2, None)
     
+    duration = None
     if start_time:
         duration = (datetime.now() - start_time).total_seconds()
         if duration > 180:
             update_reputation(user1, 1)
             update_reputation(user2, 1)
 
-    # Update DB status with safety check
-    try:
-        cur.execute("UPDATE users SET is_online=false WHERE user_id IN (%s, %s)", (user1, user2))
-    except Exception as e:
-        logging.error(f"DB Error ending chat: {e}")
+    event_log.record(reason, user1, user2, duration)
+    event_log.record_match(user1, user2, start_time, reason)
 
     # Remove from active chats
     if user1 in active_chats: del active_chats[user1]
@@ -246,6 +407,7 @@ async def end_chat(user1, user2, notify_user1=True, notify_user2=True):
             await bot.send_message(user2, "❌ Chat ended.", reply_markup=get_main_menu(user2))
         except: pass
 
+@metrics.timed
 async def connect_users(user1, user2):
     # FIX: Ensure symmetric state by ending existing chats first
     if user1 in active_chats:
@@ -263,19 +425,15 @@ async def connect_users(user1, user2):
     waiting_queue.discard(user1)
     waiting_queue.discard(user2)
 
-    # Save last_chat_user_id for reconnect and set online
+    event_counters.incr("matches")
+    event_log.record("match", user1, user2)
+
+    # Save last_chat_user_id for reconnect (online status comes from presence)
+    last_partner[user1] = user2
+    last_partner[user2] = user1
+    recent_partners.add(user1, user2)
     try:
-        cur.execute("""
-            UPDATE users
-            SET last_chat_user_id = %s, is_online = true
-            WHERE user_id = %s
-        """, (user2, user1))
-
-        cur.execute("""
-            UPDATE users
-            SET last_chat_user_id = %s, is_online = true
-            WHERE user_id = %s
-        """, (user1, user2))
+        store.set_last_partners(user1, user2)
     except Exception as e:
         logging.error(f"Error connecting users DB: {e}")
     
@@ -301,54 +459,53 @@ async def connect_users(user1, user2):
         await bot.send_message(user2, f"✅ Match found! Start chatting...{p2_badge}", reply_markup=chat_kb)
     except Exception:
         # If a user blocked the bot, force disconnect
-        await end_chat(user1, user2)
+        await end_chat(user1, user2, reason="error")
+        return
     
     # Premium feature: Show partner details to premium user
     try:
-        # Check if user1 is premium
-        if is_premium(user1):
-            cur.execute("""
-                SELECT age, gender, city, interests
-                FROM users WHERE user_id = %s
-            """, (user2,))
-            partner_row = cur.fetchone()
-            if partner_row:
-                p_age, p_gender, p_city, p_interests = partner_row
-                p_interests_text = p_interests if p_interests else "Not set"
-                details_msg = (
-                    f"⭐ You're connected with:\n"
-                    f"👤 Gender: {p_gender}\n"
-                    f"🎂 Age: {p_age}\n"
-                    f"📍 City: {p_city}\n"
-                    f"🎯 Interests: {p_interests_text}"
-                )
-                await bot.send_message(user1, details_msg, parse_mode="Markdown")
-        else:
-            await bot.send_message(user1, "🔒 Partner details hidden.\nUpgrade to Premium to see Age, Gender, City, and Interests.")
-        
-        # Check if user2 is premium
-        if is_premium(user2):
-            cur.execute("""
-                SELECT age, gender, city, interests
-                FROM users WHERE user_id = %s
-            """, (user1,))
-            partner_row = cur.fetchone()
-            if partner_row:
-                p_age, p_gender, p_city, p_interests = partner_row
-                p_interests_text = p_interests if p_interests else "Not set"
-                details_msg = (
-                    f"⭐ You're connected with:\n"
-                    f"👤 Gender: {p_gender}\n"
-                    f"🎂 Age: {p_age}\n"
-                    f"📍 City: {p_city}\n"
-                    f"🎯 Interests: {p_interests_text}"
-                )
-                await bot.send_message(user2, details_msg, parse_mode="Markdown")
-        else:
-            await bot.send_message(user2, "🔒 Partner details hidden.\nUpgrade to Premium to see Age, Gender, City, and Interests.")
+        for viewer, partner in ((user1, user2), (user2, user1)):
+            if is_premium(viewer):
+                card = profile_cards.card(partner)
+                if card:
+                    await bot.send_message(viewer, f"⭐ You're connected with:\n{card}", parse_mode="Markdown")
+            else:
+                await bot.send_message(viewer, "🔒 Partner details hidden.\nUpgrade to Premium to see Age, Gender, City, and Interests.")
     except Exception as e:
         logging.error(f"Error showing partner details: {e}")
 
+WAITING_TEXT = "🔍 Matching with a partner…\nPlease wait ⏳"
+
+async def pair_or_wait(message, partner=None, waiting_text=WAITING_TEXT):
+    """Connect the sender with a chosen waiting partner, or queue them.
+
+    Candidates are picked without locks, so the choice is re-checked under
+    both users' locks: if the partner was taken meanwhile, the sender waits.
+    """
+    uid = message.from_user.id
+    if partner is not None:
+        async with user_locks.hold(uid, partner):
+            if partner in waiting_queue and uid not in active_chats and partner not in active_chats:
+                await connect_users(uid, partner)
+                return
+
+    async with user_locks.hold(uid):
+        if uid in active_chats or uid in waiting_queue:
+            return
+        waiting_queue.add(uid)
+    await message.answer(waiting_text, reply_markup=types.ReplyKeyboardRemove())
+    schedule_timer(queue_timeout(uid))
+
+async def wait_for_batch(message, waiting_text=WAITING_TEXT, **wants):
+    """Batch mode: queue the sender with their find filters for the next tick."""
+    uid = message.from_user.id
+    await pair_or_wait(message, None, waiting_text)
+    if uid in waiting_queue:
+        profile = profile_cards.profile(uid) or {}
+        batch_matcher.add(matcher.Waiter(
+            uid, profile.get("gender"), profile.get("city"), profile.get("interests"), **wants
+        ))
+
 # ================= MENUS =================
 
 premium_submenu = ReplyKeyboardMarkup(resize_keyboard=True)
@@ -357,17 +514,24 @@ premium_submenu.add("👨📍 Find Man in My City", "👩📍 Find Woman in My C
 premium_submenu.add("🎯 Find by Interests")
 premium_submenu.add("⬅ Back to Menu")
 
-def get_main_menu(uid):
+def build_main_menu(premium):
     menu = ReplyKeyboardMarkup(resize_keyboard=True)
     menu.add("🔍 Find Chat")
-    if is_premium(uid):
+    if premium:
         menu.add("💎 Premium Search")
     menu.add("⭐ Premium", "👤 Profile")
     menu.add("🎁 Invite & Earn", "📜 Rules")
     menu.add("⚙ Settings", "🔁 Reconnect")
     return menu
 
-@dp.message_handler(text="💎 Premium Search")
+# Both variants are built once and shared by every reply
+main_menu_free = build_main_menu(premium=False)
+main_menu_premium = build_main_menu(premium=True)
+
+def get_main_menu(uid):
+    return main_menu_premium if is_premium(uid) else main_menu_free
+
+@router.text("💎 Premium Search")
 async def open_premium_menu(message: types.Message):
     uid = message.from_user.id
     
@@ -378,11 +542,7 @@ async def open_premium_menu(message: types.Message):
         if uid not in upsell_shown:
             upsell_shown.add(uid)
             await message.answer(
-                "⭐ *Unlock Premium Logic*\n\n"
-                "• Find by Gender (Man/Woman)\n"
-                "• Find by Interests & City\n"
-                "• See Partner Details\n"
-                "• No Ads & Priority Support",
+                UPSELL_TEXT,
                 parse_mode="Markdown",
                 reply_markup=upsell_kb
             )
@@ -397,7 +557,7 @@ async def open_premium_menu(message: types.Message):
         reply_markup=premium_submenu
     )
 
-@dp.message_handler(text="⬅ Back to Menu")
+@router.text("⬅ Back to Menu")
 async def back_to_main_menu(message: types.Message):
     await message.answer("🏠 Main Menu", reply_markup=get_main_menu(message.from_user.id))
 
@@ -405,6 +565,24 @@ chat_kb = ReplyKeyboardMarkup(resize_keyboard=True)
 chat_kb.add("🚫 Block", "🚨 Report")
 chat_kb.add("⛔ Stop", "➡ Next")
 
+# Typed profile fields and the prompt shown when a value is rejected
+INVALID_PROFILE_VALUE = {
+    "age": "❌ Enter a valid age (13–80):",
+    "gender": "❌ Enter Male or Female:",
+    "city": "❌ Enter a valid city:",
+    "country": "❌ Enter a valid country:",
+}
+
+def validate_profile_value(field, text):
+    """Normalize a typed profile value, or return None if it is invalid."""
+    if field == "age":
+        return int(text) if text.isdigit() and 13 <= int(text) <= 80 else None
+    if field == "gender":
+        return text.capitalize() if text.lower() in ("male", "female") else None
+    if field in ("city", "country"):
+        return text if 0 < len(text) <= 64 else None
+    return None
+
 def get_interest_kb(selected_interests):
     kb = InlineKeyboardMarkup(row_width=2)
     for interest in AVAILABLE_INTERESTS:
@@ -420,32 +598,28 @@ def get_interest_kb(selected_interests):
 
 # ================= START & REGISTRATION =================
 
-@dp.message_handler(commands=["start"])
+@router.command("start")
 async def start(message: types.Message):
     uid = message.from_user.id
     args = message.get_args()
     
-    cur.execute("SELECT age, banned FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-
-    if row and row[1]:
+    if ban_service.is_banned(uid):
         return await message.answer("🚫 You have been banned from using this bot.")
 
-    if not row:
+    if not store.user_exists(uid):
         # Check referral
         referrer_id = None
         if args and args.isdigit():
             possible_ref = int(args)
             if possible_ref != uid:
                 # Validate referrer exists
-                cur.execute("SELECT 1 FROM users WHERE user_id=%s", (possible_ref,))
-                if cur.fetchone():
+                if store.user_exists(possible_ref):
                     referrer_id = possible_ref
 
-        cur.execute("""
-            INSERT INTO users (user_id, username, age, gender, city, country, interests, blocked_users, premium_until, referred_by)
-            VALUES (%s, %s, 0, '', '', '', '', '{}', NOW() + INTERVAL '2 hours', %s)
-        """, (uid, message.from_user.username or "", referrer_id))
+        store.create_user(uid, message.from_user.username or "", referrer_id, trial_hours=storage.TRIAL_HOURS)
+        premium_until.pop(uid, None)
+        profile_cards.invalidate(uid)
+        event_counters.incr("joins")
         
         # Free Premium Message
         await message.answer(
@@ -458,15 +632,21 @@ async def start(message: types.Message):
             parse_mode="Markdown"
         )
         
-        onboarding_state[uid] = "age"
+        onboarding_state[uid] = {"step": "age"}
         return await message.answer("Welcome! Let's set up your profile.\n\n🎂 Enter your age:")
     
+    # Registration that was abandoned (its state expired, or the bot
+    # restarted) left a blank profile behind: start it over
+    row = profile_cards.profile(uid)
+    if not row or not row["age"] or not row["gender"]:
+        onboarding_state[uid] = {"step": "age"}
+        return await message.answer("Let's finish setting up your profile.\n\n🎂 Enter your age:")
+
     # Premium Expiry Reminder
     try:
-        cur.execute("SELECT premium_until FROM users WHERE user_id=%s", (uid,))
-        p_row = cur.fetchone()
-        if p_row and p_row[0] and p_row[0] > datetime.now():
-            time_left = p_row[0] - datetime.now()
+        until = get_premium_until(uid)
+        if until and until > datetime.now():
+            time_left = until - datetime.now()
             if time_left < timedelta(hours=24) and uid not in expiry_reminded:
                 expiry_reminded.add(uid)
                 await message.answer("⚠️ Your Premium expires in less than 24 hours! Renew now to keep benefits.")
@@ -477,40 +657,32 @@ async def start(message: types.Message):
 
 # ================= PROFILE MENU =================
 
-@dp.message_handler(text="👤 Profile")
-@dp.message_handler(commands=["profile"])
+@router.text("👤 Profile")
+@router.command("profile")
 async def profile(message: types.Message):
     uid = message.from_user.id
     
     try:
-        cur.execute("""
-            SELECT age, gender, city, country, interests, premium_until
-            FROM users WHERE user_id=%s
-        """, (uid,))
-        row = cur.fetchone()
+        row = profile_cards.profile(uid)
         
         if not row:
             return await message.answer("❌ No profile found. Please /start again.")
         
-        age, gender, city, country, interests, premium_until = row
+        until = get_premium_until(uid)
         
-        premium_text = "⭐ Premium User" if premium_until and premium_until > datetime.now() else "❌ Not Active"
+        premium_text = "⭐ Premium User" if until and until > datetime.now() else "❌ Not Active"
         
         # Premium Expiry Reminder
-        if premium_until and premium_until > datetime.now():
-            time_left = premium_until - datetime.now()
+        if until and until > datetime.now():
+            time_left = until - datetime.now()
             if time_left < timedelta(hours=24) and uid not in expiry_reminded:
                 expiry_reminded.add(uid)
                 await message.answer("⚠️ Your Premium expires in less than 24 hours! Renew now to keep benefits.")
-        interests_text = interests if interests else "Not set"
         
         profile_text = (
             f"👤 *Your Profile*\n\n"
-            f"🎂 Age: {age}\n"
-            f"⚧ Gender: {gender}\n"
-            f"🏙 City: {city}\n"
-            f"🌍 Country: {country}\n"
-            f"🎯 Interests: {interests_text}\n"
+            f"{profile_cards.card(uid)}\n"
+            f"🌍 Country: {row['country']}\n"
             f"⭐ Premium: {premium_text}"
         )
         
@@ -521,8 +693,8 @@ async def profile(message: types.Message):
 
 # ================= SETTINGS =================
 
-@dp.message_handler(text="⚙ Settings")
-@dp.message_handler(commands=["settings"])
+@router.text("⚙ Settings")
+@router.command("settings")
 async def settings(message: types.Message):
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("🎂 Edit Age", callback_data="edit_age"))
@@ -539,28 +711,50 @@ async def edit_field(callback: types.CallbackQuery):
     if field == "interests":
         uid = callback.from_user.id
         try:
-            cur.execute("SELECT interests FROM users WHERE user_id=%s", (uid,))
-            row = cur.fetchone()
-            selected = row[0].split(", ") if row and row[0] else []
+            # Toggles edit this in memory; interests_done writes it once
+            interest_state[uid] = selected = load_interests(uid)
             await callback.message.answer("🏷 Select your interests:", reply_markup=get_interest_kb(selected))
         except Exception as e:
             logging.error(f"Interests edit error: {e}")
             await callback.message.answer("❌ Error loading interests.")
-    else:
+    elif field in INVALID_PROFILE_VALUE:
         user_edit_state[callback.from_user.id] = field
         await callback.message.answer(f"Enter new value for *{field}*:", parse_mode="Markdown")
     
     await callback.answer()
 
+def load_interests(uid):
+    profile = profile_cards.profile(uid)
+    return profile["interests"].split(", ") if profile and profile["interests"] else []
+
+def interest_selection(uid):
+    """The picker's current selection: kept in the onboarding profile while
+    registering, so it lives as long as the rest of the answers."""
+    profile = onboarding_state.get(uid)
+    if profile and profile.get("step") == "interests":
+        return profile["interests"]
+    if uid not in interest_state:
+        interest_state[uid] = load_interests(uid)
+    return interest_state[uid]
+
+def keep_interest_selection(uid, selected):
+    """Restart the idle timeout of an open picker after a toggle."""
+    profile = onboarding_state.get(uid)
+    if profile and profile.get("step") == "interests":
+        onboarding_state[uid] = profile
+    else:
+        interest_state[uid] = selected
+
 @dp.callback_query_handler(lambda c: c.data.startswith("toggle_interest:"))
 async def toggle_interest(callback: types.CallbackQuery):
     interest = callback.data.split(":")[1]
     uid = callback.from_user.id
     
     try:
-        cur.execute("SELECT interests FROM users WHERE user_id=%s", (uid,))
-        row = cur.fetchone()
-        selected = row[0].split(", ") if row and row[0] else []
+        selected = interest_selection(uid)
+        
+        if interest not in AVAILABLE_INTERESTS:
+            return await callback.answer()
         
         if interest in selected:
             selected.remove(interest)
@@ -569,6 +763,7 @@ async def toggle_interest(callback: types.CallbackQuery):
                 await callback.answer("❌ Free users can select up to 3 interests.", show_alert=True)
                 return
             selected.append(interest)
+        keep_interest_selection(uid, selected)
         
         await callback.message.edit_reply_markup(reply_markup=get_interest_kb(selected))
     except Exception as e:
@@ -581,20 +776,34 @@ async def interests_done(callback: types.CallbackQuery):
     uid = callback.from_user.id
     
     try:
-        cur.execute("SELECT interests FROM users WHERE user_id=%s", (uid,))
-        row = cur.fetchone()
-        selected = row[0].split(", ") if row and row[0] else []
-        interests_str = ", ".join(selected)
-        
-        cur.execute("UPDATE users SET interests=%s WHERE user_id=%s", (interests_str, uid))
-        
-        if uid in onboarding_state:
+        profile = onboarding_state.get(uid)
+        if profile and profile.get("step") == "interests":
+            interests_str = ", ".join(profile["interests"])
+            # Onboarding: the whole profile is committed in one upsert
+            row = store.save_profile(
+                uid, age=profile["age"], gender=profile["gender"], city=profile["city"],
+                country=profile["country"], interests=interests_str
+            )
+            profile_cards.invalidate(uid)
             del onboarding_state[uid]
             await callback.message.answer("✅ Profile complete!", reply_markup=get_main_menu(uid))
         else:
+            selected = interest_state.pop(uid, None)
+            if selected is None:
+                # The picker sat idle past STATE_TTL_SECONDS and its toggles are gone
+                interest_state[uid] = selected = load_interests(uid)
+                await callback.message.answer(
+                    "⌛ Your selection expired. Select your interests again:",
+                    reply_markup=get_interest_kb(selected)
+                )
+                return await callback.answer()
+            interests_str = ", ".join(selected)
+            row = store.save_profile(uid, interests=interests_str)
+            profile_cards.invalidate(uid)
             await callback.message.answer(f"✅ Interests updated!\n\n🎯 {interests_str}", reply_markup=get_main_menu(uid))
             
-        await check_referral_reward(uid)
+        if row:
+            await check_referral_reward(uid, row)
             
     except Exception as e:
         logging.error(f"Interests done error: {e}")
@@ -604,14 +813,13 @@ async def interests_done(callback: types.CallbackQuery):
 
 # ================= MATCHING =================
 
-@dp.message_handler(text="🔍 Find Chat")
-@dp.message_handler(commands=["find"])
+@router.text("🔍 Find Chat")
+@router.command("find")
+@metrics.timed
 async def find_chat(message: types.Message):
     uid = message.from_user.id
     
-    cur.execute("SELECT banned FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if row and row[0]:
+    if ban_service.is_banned(uid):
         return await message.answer("🚫 You have been banned.")
     
     if uid in active_chats:
@@ -620,20 +828,10 @@ async def find_chat(message: types.Message):
     if uid in waiting_queue:
         return await message.answer("⏳ Already searching...")
     
-    blocked_users = get_blocked_users(uid)
+    if batch_matcher:
+        return await wait_for_batch(message)
     
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    candidates = store.find_candidates(uid)
     preferred = []
     others = []
     
@@ -643,6 +841,9 @@ async def find_chat(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         # Safety & Reputation Checks
         if rpt >= 5: continue
@@ -653,23 +854,17 @@ async def find_chat(message: types.Message):
         else:
             others.append((pid, score))
             
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
     elif others:
         partner = random.choice(others)[0]
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="👨 Find a Man")
+@router.text("👨 Find a Man")
+@metrics.timed
 async def find_man(message: types.Message):
     uid = message.from_user.id
     
@@ -677,20 +872,14 @@ async def find_man(message: types.Message):
         if uid not in upsell_shown:
             upsell_shown.add(uid)
             await message.answer(
-                "⭐ *Unlock Premium Logic*\n\n"
-                "• Find by Gender (Man/Woman)\n"
-                "• Find by Interests & City\n"
-                "• See Partner Details\n"
-                "• No Ads & Priority Support",
+                UPSELL_TEXT,
                 parse_mode="Markdown",
                 reply_markup=upsell_kb
             )
             return
         return await message.answer("⭐ This feature requires Premium.\nType /premium to upgrade.")
     
-    cur.execute("SELECT banned FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if row and row[0]:
+    if ban_service.is_banned(uid):
         return await message.answer("🚫 You have been banned.")
     
     if uid in active_chats:
@@ -699,21 +888,10 @@ async def find_man(message: types.Message):
     if uid in waiting_queue:
         return await message.answer("⏳ Already searching...")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND gender = 'Male'
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    if batch_matcher:
+        return await wait_for_batch(message, want_gender="Male", strict=True)
+    
+    candidates = store.find_candidates(uid, gender="Male")
     preferred = []
     
     for r in candidates:
@@ -722,6 +900,9 @@ async def find_man(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         # Safety & Reputation Checks
         if rpt >= 5: continue
@@ -730,19 +911,15 @@ async def find_man(message: types.Message):
         
         preferred.append((pid, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="👩 Find a Woman")
+@router.text("👩 Find a Woman")
+@metrics.timed
 async def find_woman(message: types.Message):
     uid = message.from_user.id
     
@@ -750,20 +927,14 @@ async def find_woman(message: types.Message):
         if uid not in upsell_shown:
             upsell_shown.add(uid)
             await message.answer(
-                "⭐ *Unlock Premium Logic*\n\n"
-                "• Find by Gender (Man/Woman)\n"
-                "• Find by Interests & City\n"
-                "• See Partner Details\n"
-                "• No Ads & Priority Support",
+                UPSELL_TEXT,
                 parse_mode="Markdown",
                 reply_markup=upsell_kb
             )
             return
         return await message.answer("⭐ This feature requires Premium.\nType /premium to upgrade.")
     
-    cur.execute("SELECT banned FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if row and row[0]:
+    if ban_service.is_banned(uid):
         return await message.answer("🚫 You have been banned.")
     
     if uid in active_chats:
@@ -772,21 +943,10 @@ async def find_woman(message: types.Message):
     if uid in waiting_queue:
         return await message.answer("⏳ Already searching...")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND gender = 'Female'
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    if batch_matcher:
+        return await wait_for_batch(message, want_gender="Female", strict=True)
+    
+    candidates = store.find_candidates(uid, gender="Female")
     preferred = []
     
     for r in candidates:
@@ -795,6 +955,9 @@ async def find_woman(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         # Safety & Reputation Checks
         if rpt >= 5: continue
@@ -803,19 +966,15 @@ async def find_woman(message: types.Message):
         
         preferred.append((pid, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="🎯 Find by Interests")
+@router.text("🎯 Find by Interests")
+@metrics.timed
 async def find_interests(message: types.Message):
     uid = message.from_user.id
     
@@ -826,39 +985,30 @@ async def find_interests(message: types.Message):
             return
         return await message.answer("⭐ This feature requires Premium.")
     
-    cur.execute("SELECT interests FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    profile = profile_cards.profile(uid)
+    if not profile or not profile["interests"]:
         return await message.answer("⚠️ You haven't set your interests yet! Go to 👤 Profile.")
     
-    my_interests = row[0]
+    my_interests = profile["interests"]
     
     if uid in active_chats or uid in waiting_queue:
         return await message.answer("❌ Finish your current chat first.")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, interests, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND interests IS NOT NULL
-          AND interests != ''
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, tuple(blocked_users) if blocked_users else (0,), uid, uid))
+    if batch_matcher:
+        return await wait_for_batch(message, want_interests=True, strict=True)
+    
+    candidates = store.find_candidates(uid, with_interests=True)
     
     my_set = set(my_interests.split(", "))
     preferred = []
     
-    for r in cur.fetchall():
-        partner_id, partner_interests, report_count, score = r
+    for r in candidates:
+        partner_id, report_count, score, partner_interests = r
         score = score or 0
         
-        if partner_id in waiting_queue:
+        if (partner_id in waiting_queue and user_presence.is_online(partner_id)
+                and not block_index.blocks_either(uid, partner_id)
+                and not recent_partners.contains(uid, partner_id)):
             # Safety & Reputation Checks
             rpt = report_count or 0
             if rpt >= 5: continue
@@ -869,19 +1019,15 @@ async def find_interests(message: types.Message):
             if my_set & partner_set:
                 preferred.append((partner_id, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="🏙 Find in My City")
+@router.text("🏙 Find in My City")
+@metrics.timed
 async def find_city(message: types.Message):
     uid = message.from_user.id
     
@@ -892,31 +1038,19 @@ async def find_city(message: types.Message):
             return
         return await message.answer("⭐ This feature requires Premium.")
     
-    cur.execute("SELECT city FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    profile = profile_cards.profile(uid)
+    if not profile or not profile["city"]:
         return await message.answer("⚠️ You haven't set your city yet! Go to 👤 Profile.")
     
-    my_city = row[0]
+    my_city = profile["city"]
     
     if uid in active_chats or uid in waiting_queue:
         return await message.answer("❌ Finish your current chat first.")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND city = %s
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, my_city, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    if batch_matcher:
+        return await wait_for_batch(message, f"🔄 Looking for someone in {my_city}...", want_city=True, strict=True)
+    
+    candidates = store.find_candidates(uid, city=my_city)
     preferred = []
     
     for r in candidates:
@@ -925,6 +1059,9 @@ async def find_city(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         # Safety & Reputation Checks
         if rpt >= 5: continue
@@ -933,19 +1070,15 @@ async def find_city(message: types.Message):
         
         preferred.append((pid, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer(f"🔄 Looking for someone in {my_city}...", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner, f"🔄 Looking for someone in {my_city}...")
 
-@dp.message_handler(text="�📍 Find Man in My City")
+@router.text("👨📍 Find Man in My City")
+@metrics.timed
 async def find_man_city(message: types.Message):
     uid = message.from_user.id
     
@@ -956,32 +1089,19 @@ async def find_man_city(message: types.Message):
             return
         return await message.answer("⭐ This feature requires Premium.")
     
-    cur.execute("SELECT city FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    profile = profile_cards.profile(uid)
+    if not profile or not profile["city"]:
         return await message.answer("⚠️ You haven't set your city yet! Go to 👤 Profile.")
     
-    my_city = row[0]
+    my_city = profile["city"]
     
     if uid in active_chats or uid in waiting_queue:
         return await message.answer("❌ Finish your current chat first.")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND city = %s
-          AND gender = 'Male'
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, my_city, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    if batch_matcher:
+        return await wait_for_batch(message, want_gender="Male", want_city=True, strict=True)
+    
+    candidates = store.find_candidates(uid, gender="Male", city=my_city)
     preferred = []
     
     for r in candidates:
@@ -990,6 +1110,9 @@ async def find_man_city(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         if rpt >= 5: continue
         if rpt >= 3: continue
@@ -997,19 +1120,15 @@ async def find_man_city(message: types.Message):
         
         preferred.append((pid, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="👩📍 Find Woman in My City")
+@router.text("👩📍 Find Woman in My City")
+@metrics.timed
 async def find_woman_city(message: types.Message):
     uid = message.from_user.id
     
@@ -1020,32 +1139,19 @@ async def find_woman_city(message: types.Message):
             return
         return await message.answer("⭐ This feature requires Premium.")
     
-    cur.execute("SELECT city FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    profile = profile_cards.profile(uid)
+    if not profile or not profile["city"]:
         return await message.answer("⚠️ You haven't set your city yet! Go to 👤 Profile.")
     
-    my_city = row[0]
+    my_city = profile["city"]
     
     if uid in active_chats or uid in waiting_queue:
         return await message.answer("❌ Finish your current chat first.")
     
-    blocked_users = get_blocked_users(uid)
-    
-    cur.execute("""
-        SELECT user_id, report_count, reputation_score FROM users
-        WHERE user_id != %s
-          AND city = %s
-          AND gender = 'Female'
-          AND user_id NOT IN %s
-          AND user_id NOT IN (
-              SELECT unnest(blocked_users) FROM users WHERE user_id = %s
-          )
-          AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
-          AND banned = false
-    """, (uid, my_city, tuple(blocked_users) if blocked_users else (0,), uid, uid))
-    
-    candidates = cur.fetchall()
+    if batch_matcher:
+        return await wait_for_batch(message, want_gender="Female", want_city=True, strict=True)
+    
+    candidates = store.find_candidates(uid, gender="Female", city=my_city)
     preferred = []
     
     for r in candidates:
@@ -1054,6 +1160,9 @@ async def find_woman_city(message: types.Message):
         score = r[2] or 0
         
         if pid not in waiting_queue: continue
+        if block_index.blocks_either(uid, pid): continue
+        if recent_partners.contains(uid, pid): continue
+        if not user_presence.is_online(pid): continue
         
         if rpt >= 5: continue
         if rpt >= 3: continue
@@ -1061,19 +1170,15 @@ async def find_woman_city(message: types.Message):
         
         preferred.append((pid, score))
     
+    partner = None
     if preferred:
         preferred.sort(key=lambda x: x[1], reverse=True)
         top_n = max(1, int(len(preferred) * 0.75))
         partner = random.choice(preferred[:top_n])[0]
-        
-        waiting_queue.discard(partner)
-        await connect_users(uid, partner)
-    else:
-        waiting_queue.add(uid)
-        await message.answer("🔍 Matching with a partner…\nPlease wait ⏳", reply_markup=types.ReplyKeyboardRemove())
-        asyncio.create_task(queue_timeout(uid))
+    await pair_or_wait(message, partner)
 
-@dp.message_handler(text="�� Reconnect")
+@router.text("🔁 Reconnect")
+@metrics.timed
 async def reconnect(message: types.Message):
     uid = message.from_user.id
     
@@ -1081,31 +1186,24 @@ async def reconnect(message: types.Message):
         return await message.answer("❌ You are already in a chat.")
     
     try:
-        cur.execute("SELECT last_chat_user_id FROM users WHERE user_id=%s", (uid,))
-        row = cur.fetchone()
+        partner_id = last_partner.get(uid)
+        if partner_id is None:
+            partner_id = store.get_last_partner(uid)
         
-        if not row or not row[0]:
+        if not partner_id:
             return await message.answer("❌ No previous chat found to reconnect.")
         
-        partner_id = row[0]
-        
-        cur.execute("SELECT is_online, blocked_users FROM users WHERE user_id=%s", (partner_id,))
-        p_row = cur.fetchone()
-        
-        if not p_row:
-            return await message.answer("❌ User not found.")
-            
-        is_online = p_row[0]
-        partner_blocked = p_row[1] or []
-        
-        if not is_online:
+        if not user_presence.is_online(partner_id):
             return await message.answer("❌ User is offline.")
             
-        if uid in partner_blocked:
+        if block_index.blocks_either(uid, partner_id):
             return await message.answer("❌ Cannot reconnect.")
         
-        update_reputation(uid, 2)
-        await connect_users(uid, partner_id)
+        async with user_locks.hold(uid, partner_id):
+            if uid in active_chats:
+                return await message.answer("❌ You are already in a chat.")
+            update_reputation(uid, 2)
+            await connect_users(uid, partner_id)
     
     except Exception as e:
         logging.error(f"Reconnect error: {e}")
@@ -1113,12 +1211,18 @@ async def reconnect(message: types.Message):
 
 # ================= ACTIONS =================
 
-@dp.message_handler(text="⛔ Stop")
+@router.text("⛔ Stop")
+@metrics.timed
 async def stop_chat(message: types.Message):
     uid = message.from_user.id
+    partner = active_chats.get(uid)
     
-    if uid in active_chats:
-        partner = active_chats[uid]
+    if partner is None:
+        return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
+    
+    async with user_locks.hold(uid, partner):
+        if active_chats.get(uid) != partner:
+            return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
         
         # Reputation Logic
         start = chat_start_times.get(uid)
@@ -1131,45 +1235,48 @@ async def stop_chat(message: types.Message):
             update_reputation(uid, 2)
             
         await end_chat(uid, partner)
-    else:
-        await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
 
-@dp.message_handler(text="➡ Next")
+@router.text("➡ Next")
+@metrics.timed
 async def next_chat(message: types.Message):
     uid = message.from_user.id
     
-    if uid not in active_chats:
-        return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
+    partner = active_chats.get(uid)
     
-    partner = active_chats[uid]
+    if partner is None:
+        return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
     
-    # Reputation Logic
-    start = chat_start_times.get(uid)
-    if start:
-        duration = (datetime.now() - start).total_seconds()
-        if duration < 10:
-            update_reputation(uid, -1)
+    async with user_locks.hold(uid, partner):
+        if active_chats.get(uid) != partner:
+            return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
+        
+        # Reputation Logic
+        start = chat_start_times.get(uid)
+        if start:
+            duration = (datetime.now() - start).total_seconds()
+            if duration < 10:
+                update_reputation(uid, -1)
             
-    if is_premium(uid):
-        update_reputation(uid, 2)
+        if is_premium(uid):
+            update_reputation(uid, 2)
         
-    update_reputation(partner, 1) # Partner pressed next -> +1
+        update_reputation(partner, 1) # Partner pressed next -> +1
     
-    # Rapid Skips Logic
-    now = datetime.now()
-    history = skip_history.get(uid, [])
-    history = [t for t in history if (now - t).total_seconds() < 60]
-    history.append(now)
-    skip_history[uid] = history
+        # Rapid Skips Logic
+        now = datetime.now()
+        history = skip_history.get(uid, [])
+        history = [t for t in history if (now - t).total_seconds() < 60]
+        history.append(now)
+        skip_history[uid] = history
     
-    if len(history) > 3:
-        update_reputation(uid, -2)
+        if len(history) > 3:
+            update_reputation(uid, -2)
     
-    await end_chat(uid, partner)
+        await end_chat(uid, partner, reason="skip")
     
     await find_chat(message)
 
-@dp.message_handler(text="🚨 Report")
+@router.text("🚨 Report")
 async def report_init(message: types.Message):
     uid = message.from_user.id
     
@@ -1198,29 +1305,18 @@ async def report_submit(callback: types.CallbackQuery):
         return await callback.answer("❌ Report expired.", show_alert=True)
     
     partner = report_state.pop(uid)
+    reason = callback.data[len("report_"):]
     
-    try:
-        cur.execute("""
-            UPDATE users
-            SET report_count = COALESCE(report_count, 0) + 1
-            WHERE user_id = %s
-        """, (partner,))
-        
-        logging.info(f"REPORT: {uid} reported {partner} for {callback.data} at {datetime.now()}")
-        
-        update_reputation(partner, -3)
-        
-        # if check_and_auto_ban(partner):
-        #    await bot.send_message(partner, "🚫 You have been banned due to multiple reports.")
-        
-        await callback.message.answer("✅ Report submitted. Thank you.", reply_markup=get_main_menu(uid))
-    except Exception as e:
-        logging.error(f"Report error: {e}")
-        await callback.message.answer("❌ Error submitting report.")
+    # report_count, reputation and auto-ban are handled by moderation_task
+    moderation_queue.submit(uid, partner, reason)
+    logging.info(f"REPORT: {uid} reported {partner} for {reason} at {datetime.now()}")
+    event_counters.incr("reports")
+    event_log.record("report", uid, partner)
     
+    await callback.message.answer("✅ Report submitted. Thank you.", reply_markup=get_main_menu(uid))
     await callback.answer()
 
-@dp.message_handler(text="🚫 Block")
+@router.text("🚫 Block")
 async def block_user(message: types.Message):
     uid = message.from_user.id
     
@@ -1230,14 +1326,13 @@ async def block_user(message: types.Message):
     partner = active_chats[uid]
     
     try:
-        cur.execute("""
-            UPDATE users
-            SET blocked_users = array_append(blocked_users, %s)
-            WHERE user_id = %s AND NOT (%s = ANY(blocked_users))
-        """, (partner, uid, partner))
+        store.add_block(uid, partner)
+        block_index.add(uid, partner)
         
-        update_reputation(partner, -5)
-        await end_chat(uid, partner)
+        async with user_locks.hold(uid, partner):
+            if active_chats.get(uid) == partner:
+                update_reputation(partner, -5)
+                await end_chat(uid, partner, reason="block")
         await message.answer("🚫 User blocked.", reply_markup=get_main_menu(uid))
     except Exception as e:
         logging.error(f"Block error: {e}")
@@ -1245,66 +1340,73 @@ async def block_user(message: types.Message):
 
 # ================= COMMANDS =================
 
-@dp.message_handler(commands=["stop"])
+@router.command("stop")
 async def stop_command(message: types.Message):
     uid = message.from_user.id
+    partner = active_chats.get(uid)
     
-    if uid in active_chats:
-        partner = active_chats[uid]
-        
-        # Reputation Logic
-        start = chat_start_times.get(uid)
-        if start:
-            duration = (datetime.now() - start).total_seconds()
-            if duration < 10:
-                update_reputation(uid, -1)
-        
-        if is_premium(uid):
-            update_reputation(uid, 2)
+    if partner is not None:
+        async with user_locks.hold(uid, partner):
+            if active_chats.get(uid) != partner:
+                return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
             
-        await end_chat(uid, partner)
+            # Reputation Logic
+            start = chat_start_times.get(uid)
+            if start:
+                duration = (datetime.now() - start).total_seconds()
+                if duration < 10:
+                    update_reputation(uid, -1)
+            
+            if is_premium(uid):
+                update_reputation(uid, 2)
+                
+            await end_chat(uid, partner)
     elif uid in waiting_queue:
         waiting_queue.discard(uid)
         await message.answer("❌ Search cancelled.", reply_markup=get_main_menu(uid))
     else:
         await message.answer("❌ You are not in a chat or searching.", reply_markup=get_main_menu(uid))
 
-@dp.message_handler(commands=["next"])
+@router.command("next")
 async def next_command(message: types.Message):
     uid = message.from_user.id
     
-    if uid not in active_chats:
-        return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
+    partner = active_chats.get(uid)
     
-    partner = active_chats[uid]
+    if partner is None:
+        return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
     
-    # Reputation Logic
-    start = chat_start_times.get(uid)
-    if start:
-        duration = (datetime.now() - start).total_seconds()
-        if duration < 10:
-            update_reputation(uid, -1)
+    async with user_locks.hold(uid, partner):
+        if active_chats.get(uid) != partner:
+            return await message.answer("❌ You are not in a chat.", reply_markup=get_main_menu(uid))
+        
+        # Reputation Logic
+        start = chat_start_times.get(uid)
+        if start:
+            duration = (datetime.now() - start).total_seconds()
+            if duration < 10:
+                update_reputation(uid, -1)
             
-    if is_premium(uid):
-        update_reputation(uid, 2)
+        if is_premium(uid):
+            update_reputation(uid, 2)
         
-    update_reputation(partner, 1)
+        update_reputation(partner, 1)
     
-    # Rapid Skips Logic
-    now = datetime.now()
-    history = skip_history.get(uid, [])
-    history = [t for t in history if (now - t).total_seconds() < 60]
-    history.append(now)
-    skip_history[uid] = history
+        # Rapid Skips Logic
+        now = datetime.now()
+        history = skip_history.get(uid, [])
+        history = [t for t in history if (now - t).total_seconds() < 60]
+        history.append(now)
+        skip_history[uid] = history
     
-    if len(history) > 3:
-        update_reputation(uid, -2)
+        if len(history) > 3:
+            update_reputation(uid, -2)
 
-    await end_chat(uid, partner)
+        await end_chat(uid, partner, reason="skip")
     
     await find_chat(message)
 
-@dp.message_handler(commands=["shareprofile"])
+@router.command("shareprofile")
 async def shareprofile_init(message: types.Message):
     uid = message.from_user.id
     
@@ -1336,25 +1438,12 @@ async def shareprofile_init(message: types.Message):
         partner_id = active_chats[uid]
         
         try:
-            cur.execute("""
-                SELECT age, gender, city, interests
-                FROM users WHERE user_id = %s
-            """, (uid,))
-            row = cur.fetchone()
+            card = profile_cards.card(uid)
             
-            if not row:
+            if not card:
                 return await message.answer("❌ Profile data not found.")
             
-            age, gender, city, interests = row
-            interests_text = interests if interests else "Not set"
-            
-            shared_msg = (
-                f"📤 *Partner shared their profile:*\n\n"
-                f"🎂 Age: {age}\n"
-                f"⚧ Gender: {gender}\n"
-                f"🏙 City: {city}\n"
-                f"🎯 Interests: {interests_text}"
-            )
+            shared_msg = f"📤 *Partner shared their profile:*\n\n{card}"
             
             await bot.send_message(partner_id, shared_msg, parse_mode="Markdown")
             await message.answer("✅ Your profile has been shared with your chat partner.")
@@ -1365,23 +1454,20 @@ async def shareprofile_init(message: types.Message):
 
 # ================= PREMIUM & PAYMENTS =================
 
-@dp.message_handler(text="⭐ Premium")
-@dp.message_handler(commands=["premium"])
-async def premium_menu(message: types.Message):
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton("⭐ 7 Days – 30 Stars", callback_data="buy_7"),
-        InlineKeyboardButton("⭐ 30 Days – 120 Stars", callback_data="buy_30")
-    )
-    await message.answer("Upgrade to Premium", reply_markup=kb)
+# {callback_data: (days, stars)}
+PREMIUM_PLANS = {
+    "buy_7": (7, 30),
+    "buy_30": (30, 120),
+}
 
-@dp.callback_query_handler(lambda c: c.data.startswith("buy_"))
-async def buy_callback(callback: types.CallbackQuery):
-    days = 7 if callback.data == "buy_7" else 30
-    stars = 30 if days == 7 else 120
+premium_kb = InlineKeyboardMarkup()
+premium_kb.add(*(
+    InlineKeyboardButton(f"⭐ {days} Days – {stars} Stars", callback_data=data)
+    for data, (days, stars) in PREMIUM_PLANS.items()
+))
 
-    await bot.send_invoice(
-        callback.message.chat.id,
+PREMIUM_INVOICES = {
+    data: dict(
         title="Chatogram Premium ⭐",
         description=f"Premium access for {days} days",
         payload=f"premium_{days}",
@@ -1389,93 +1475,130 @@ async def buy_callback(callback: types.CallbackQuery):
         currency="XTR",
         prices=[LabeledPrice("Premium", stars)]
     )
+    for data, (days, stars) in PREMIUM_PLANS.items()
+}
+PREMIUM_PAYLOAD_DAYS = {f"premium_{days}": days for days, _ in PREMIUM_PLANS.values()}
+
+@router.text("⭐ Premium")
+@router.command("premium")
+async def premium_menu(message: types.Message):
+    await message.answer("Upgrade to Premium", reply_markup=premium_kb)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("buy_"))
+async def buy_callback(callback: types.CallbackQuery):
+    invoice = PREMIUM_INVOICES.get(callback.data)
+    if not invoice:
+        return await callback.answer()
+
+    await bot.send_invoice(callback.message.chat.id, **invoice)
 
 @dp.pre_checkout_query_handler(lambda q: True)
 async def pre_checkout(q: PreCheckoutQuery):
     await bot.answer_pre_checkout_query(q.id, ok=True)
 
-@dp.message_handler(content_types=ContentType.SUCCESSFUL_PAYMENT)
+def credit_payment(uid, username, charge_id, days, payload, currency, amount):
+    """Record a payment and extend premium; None if it was already credited."""
+    try:
+        return store.record_payment(charge_id, uid, days, payload, currency, amount)
+    except LookupError:
+        # Paid without a users row (e.g. never ran /start): create it, then credit
+        logging.warning(f"Payment {charge_id} from unknown user {uid}")
+        if store.create_user(uid, username or ""):
+            event_counters.incr("joins")
+        premium_until.pop(uid, None)
+        profile_cards.invalidate(uid)
+        return store.record_payment(charge_id, uid, days, payload, currency, amount)
+
+@router.content_type(ContentType.SUCCESSFUL_PAYMENT)
 async def successful_payment(message: types.Message):
-    payload = message.successful_payment.invoice_payload
-    days = 7 if payload == "premium_7" else 30
+    uid = message.from_user.id
+    payment = message.successful_payment
+    days = PREMIUM_PAYLOAD_DAYS.get(payment.invoice_payload, 30)
     
-    cur.execute("""
-        UPDATE users
-        SET premium_until = COALESCE(premium_until, NOW()) + INTERVAL '%s days'
-        WHERE user_id = %s
-    """, (days, message.from_user.id))
+    # Keyed by the charge id: a redelivered update extends nothing
+    charge_id = payment.telegram_payment_charge_id
+    try:
+        until = credit_payment(
+            uid, message.from_user.username,
+            charge_id, days, payment.invoice_payload, payment.currency, payment.total_amount,
+        )
+    except Exception as e:
+        # The user has been charged: keep enough to credit them by hand
+        logging.error(
+            f"Payment {charge_id} from {uid} not credited "
+            f"({days} days, {payment.total_amount} {payment.currency}): {e}"
+        )
+        queue_notification(ADMIN_ID, f"⚠️ Payment {charge_id} from {uid} ({days} days) was not credited: {e}")
+        return await message.answer(
+            "❌ Your payment went through but Premium could not be activated yet.\n"
+            f"We have been notified. Reference: {charge_id}"
+        )
+    if until is None:
+        logging.info(f"Duplicate payment {charge_id} from {uid}")
+        return
+    premium_until[uid] = until
+    expiry_reminded.discard(uid)
+    event_counters.incr("payments")
+    event_counters.incr("stars", payment.total_amount)
     
     await message.answer(f"⭐ Premium activated for {days} days!", reply_markup=get_main_menu(message.from_user.id))
 
 # ================= ADMIN =================
 
-@dp.message_handler(lambda m: m.from_user.id in user_edit_state)
+@router.state(user_edit_state)
 async def save_profile_edit(message: types.Message):
-    field = user_edit_state.pop(message.from_user.id)
-    value = message.text.strip()
+    uid = message.from_user.id
+    field = user_edit_state.pop(uid)
+    value = validate_profile_value(field, message.text.strip())
+    
+    if value is None:
+        user_edit_state[uid] = field
+        return await message.answer(INVALID_PROFILE_VALUE[field])
     
     try:
-        cur.execute(
-            f"UPDATE users SET {field}=%s WHERE user_id=%s",
-            (value, message.from_user.id)
-        )
-        await message.answer(f"✅ {field.capitalize()} updated!", reply_markup=get_main_menu(message.from_user.id))
+        row = store.save_profile(uid, **{field: value})
+        profile_cards.invalidate(uid)
+        await message.answer(f"✅ {field.capitalize()} updated!", reply_markup=get_main_menu(uid))
         
-        await check_referral_reward(message.from_user.id)
+        if row:
+            await check_referral_reward(uid, row)
         
     except Exception as e:
         await message.answer("❌ Error updating profile.")
 
-@dp.message_handler(commands=["stats"])
+@router.command("stats")
 async def admin_stats(message: types.Message):
     if message.from_user.id != ADMIN_ID: return
     
-    try:
-        cur.execute("SELECT COUNT(*) FROM users")
-        total_users = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE is_online=true")
-        active_today = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE premium_until > NOW()")
-        premium_users = cur.fetchone()[0]
-        
-        cur.execute("SELECT SUM(referral_count) FROM users")
-        row = cur.fetchone()
-        referrals = row[0] if row and row[0] else 0
-        
-        cur.execute("SELECT SUM(report_count) FROM users")
-        row = cur.fetchone()
-        reports = row[0] if row and row[0] else 0
-        
-        chats_today = len(active_chats) // 2
-        
-        text = (
-            "📊 *Statistics*\n\n"
-            f"👥 Total Users: {total_users}\n"
-            f"⚡ Active Today: {active_today}\n"
-            f"💬 Chats Today: {chats_today}\n"
-            f"⭐ Premium Users: {premium_users}\n"
-            f"🔗 Referrals Today: {referrals}\n"
-            f"🚨 Reports Today: {reports}"
-        )
-        await message.answer(text, parse_mode="Markdown")
-    except Exception as e:
-        logging.error(f"Stats error: {e}")
-        await message.answer("❌ Error fetching stats.")
+    # Served from in-memory counters: no table scans on the shared connection
+    joins_today, total_users = event_counters.get("joins")
+    chats_today, total_chats = event_counters.get("matches")
+    payments_today, total_payments = event_counters.get("payments")
+    stars_today, _ = event_counters.get("stars")
+    referrals_today, total_referrals = event_counters.get("referrals")
+    reports_today, total_reports = event_counters.get("reports")
+
+    text = (
+        "📊 *Statistics*\n\n"
+        f"👥 Total Users: {total_users} (+{joins_today} today)\n"
+        f"🟢 Online Now: {user_presence.online_count()}\n"
+        f"⚡ Active Today: {event_counters.active_today()}\n"
+        f"💬 Chats Today: {chats_today} ({len(active_chats) // 2} live, {total_chats} total)\n"
+        f"⭐ Payments Today: {payments_today} ({stars_today} Stars, {total_payments} total)\n"
+        f"🔗 Referrals Today: {referrals_today} ({total_referrals} total)\n"
+        f"🚨 Reports Today: {reports_today} ({total_reports} total)"
+    )
+    await message.answer(text, parse_mode="Markdown")
 
-@dp.message_handler(commands=["addpremium"])
+@router.command("addpremium")
 async def add_premium_admin(message: types.Message):
     if message.from_user.id != ADMIN_ID: return
     try:
         parts = message.text.split()
         uid = int(parts[1])
         days = int(parts[2])
-        cur.execute("""
-            UPDATE users
-            SET premium_until = COALESCE(premium_until, NOW()) + INTERVAL '%s days'
-            WHERE user_id = %s
-        """, (days, uid))
+        premium_until[uid] = store.extend_premium(uid, days)
+        expiry_reminded.discard(uid)
         
         try:
             await bot.send_message(uid, "⭐ Premium activated.")
@@ -1485,80 +1608,141 @@ async def add_premium_admin(message: types.Message):
     except:
         await message.answer("Usage: /addpremium <uid> <days>")
 
-@dp.message_handler(commands=["ban"])
+@router.command("ban")
 async def ban_user_admin(message: types.Message):
     if message.from_user.id != ADMIN_ID: return
     try:
         uid = int(message.get_args())
-        cur.execute("UPDATE users SET banned=true WHERE user_id=%s", (uid,))
+        ban_service.ban(store, uid, "admin")
+        await remove_banned_user(uid)
         await message.answer(f"🚫 User {uid} banned.")
     except:
         await message.answer("Usage: /ban <uid>")
 
-@dp.message_handler(commands=["unban"])
+@router.command("unban")
 async def unban_user_admin(message: types.Message):
     if message.from_user.id != ADMIN_ID: return
     try:
         uid = int(message.get_args())
-        cur.execute("UPDATE users SET banned=false WHERE user_id=%s", (uid,))
+        ban_service.unban(store, uid)
         await message.answer(f"✅ User {uid} unbanned.")
     except:
         await message.answer("Usage: /unban <uid>")
 
+@router.command("broadcast")
+async def broadcast_admin(message: types.Message):
+    if message.from_user.id != ADMIN_ID: return
+    text = message.get_args().strip()
+    active = store.active_broadcast()
+    
+    if not text or text in ("status", "cancel"):
+        if not active:
+            return await message.answer("Usage: /broadcast <text> | status | cancel\nNo broadcast running.")
+        broadcast_id, _, last_user_id, sent, failed = active
+        if text == "cancel":
+            store.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, finished=True)
+            return await message.answer(f"📣 Broadcast #{broadcast_id} cancelled after {sent} sent.")
+        start_broadcast_job()  # No-op while delivering; revives a job that died
+        return await message.answer(f"📣 Broadcast #{broadcast_id}: {sent} sent, {failed} failed so far.")
+    
+    if active:
+        return await message.answer(f"❌ Broadcast #{active[0]} is still running. Use /broadcast cancel first.")
+    
+    broadcast_id = store.create_broadcast(text)
+    start_broadcast_job()
+    await message.answer(f"📣 Broadcast #{broadcast_id} started.")
+
+@router.command("export")
+async def export_admin(message: types.Message):
+    if message.from_user.id != ADMIN_ID: return
+    args = message.get_args().split()
+    name = args[0] if args else None
+    fmt = args[1] if len(args) > 1 else "csv"
+    
+    if name not in storage.EXPORT_TABLES or fmt not in export.FORMATS:
+        return await message.answer(
+            f"Usage: /export <{'|'.join(storage.EXPORT_TABLES)}> [{'|'.join(export.FORMATS)}]"
+        )
+    
+    await message.answer(f"⏳ Exporting {name}...")
+    try:
+        # Off the event loop: the export reads and compresses the whole table
+        file, count = await asyncio.to_thread(export.write_export, store, name, fmt)
+    except Exception as e:
+        logging.error(f"Export error: {e}")
+        return await message.answer("❌ Export failed.")
+    
+    with file:
+        size = file.seek(0, os.SEEK_END)
+        if size > export.MAX_DOCUMENT_BYTES:
+            return await message.answer(f"❌ Export is {size // (1024 * 1024)} MB, over Telegram's 50 MB upload limit.")
+        file.seek(0)
+        filename = f"{name}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}.gz"
+        await bot.send_document(message.chat.id, types.InputFile(file, filename=filename), caption=f"{count} rows")
+
 # ================= ONBOARDING =================
 
-@dp.message_handler(lambda m: m.from_user.id in onboarding_state)
+@router.state(onboarding_state)
 async def onboarding_handler(message: types.Message):
     uid = message.from_user.id
-    step = onboarding_state[uid]
+    profile = onboarding_state[uid]
+    step = profile["step"]
     text = message.text.strip()
 
+    # Answers are collected in memory; interests_done commits the profile once
+    if step == "interests":
+        return await message.answer("🏷 Select your interests above and press ✔️ Done.")
+
+    value = validate_profile_value(step, text)
+    if value is None:
+        return await message.answer(INVALID_PROFILE_VALUE[step])
+    profile[step] = value
+    onboarding_state[uid] = profile  # Each answer restarts the idle timeout
+
     if step == "age":
-        if not text.isdigit() or not (13 <= int(text) <= 80):
-            return await message.answer("❌ Enter a valid age (13–80):")
-        cur.execute("UPDATE users SET age=%s WHERE user_id=%s", (int(text), uid))
-        onboarding_state[uid] = "gender"
+        profile["step"] = "gender"
         return await message.answer("👤 Enter your gender (Male/Female):")
 
     elif step == "gender":
-        cur.execute("UPDATE users SET gender=%s WHERE user_id=%s", (text, uid))
-        onboarding_state[uid] = "city"
+        profile["step"] = "city"
         return await message.answer("🏙 Enter your city:")
 
     elif step == "city":
-        cur.execute("UPDATE users SET city=%s WHERE user_id=%s", (text, uid))
-        onboarding_state[uid] = "country"
+        profile["step"] = "country"
         return await message.answer("🌍 Enter your country:")
 
     elif step == "country":
-        cur.execute("UPDATE users SET country=%s WHERE user_id=%s", (text, uid))
-        onboarding_state[uid] = "interests"
-        
-        cur.execute("UPDATE users SET interests='' WHERE user_id=%s", (uid,))
+        profile["step"] = "interests"
+        profile["interests"] = []
         await message.answer("🏷 Now select your interests!", reply_markup=get_interest_kb([]))
 
 # ================= OTHER =================
 
-@dp.message_handler(text="🎁 Invite & Earn")
-@dp.message_handler(commands=["invite"])
+INVITE_TEXT = (
+    "Invite friends and earn Premium!\n{link}\n\n"
+    "🎁 Rewards:\n"
+    "• 1 Friend: 30 mins Premium\n"
+    "• 3 Friends: 3 hours\n"
+    "• 5 Friends: 1 day\n"
+    "• 10 Friends: 3 days"
+)
+RULES_TEXT = "1️⃣ No abuse\n2️⃣ No spam\n3️⃣ No illegal content\n4️⃣ Respect privacy"
+
+@router.text("🎁 Invite & Earn")
+@router.command("invite")
 async def invite(message: types.Message):
-    link = f"https://t.me/{(await bot.get_me()).username}?start={message.from_user.id}"
-    await message.answer(
-        f"Invite friends and earn Premium!\n{link}\n\n"
-        "🎁 Rewards:\n"
-        "• 1 Friend: 30 mins Premium\n"
-        "• 3 Friends: 3 hours\n"
-        "• 5 Friends: 1 day\n"
-        "• 10 Friends: 3 days"
-    )
+    username = bot_username or (await bot.get_me()).username
+    link = f"https://t.me/{username}?start={message.from_user.id}"
+    await message.answer(INVITE_TEXT.format(link=link))
 
-@dp.message_handler(text="📜 Rules")
-@dp.message_handler(commands=["rules"])
+@router.text("📜 Rules")
+@router.command("rules")
 async def rules(message: types.Message):
-    await message.answer("1️⃣ No abuse\n2️⃣ No spam\n3️⃣ No illegal content\n4️⃣ Respect privacy")
+    await message.answer(RULES_TEXT)
 
 # Catch-all for active chat messages
-@dp.message_handler(content_types=ContentType.ANY)
+@router.default
+@metrics.timed
 async def chat_relay(message: types.Message):
     if message.text and message.text.startswith('/'):
         return
@@ -1566,26 +1750,111 @@ async def chat_relay(message: types.Message):
     uid = message.from_user.id
     if uid in active_chats:
         partner = active_chats[uid]
+
+        action = None
+        if relay_filter:
+            action, text, _ = relay_filter.check(message.text or message.caption)
+            if action == relayfilter.BLOCK:
+                return await message.answer("🚫 Message not delivered: it breaks the /rules.")
+            if action == relayfilter.FLAG:
+                event_log.record("flag", uid, partner)
+
         try:
-            await message.copy_to(partner)
+            if action == relayfilter.MASK and message.text:
+                await bot.send_message(partner, text)
+            elif action == relayfilter.MASK:
+                await message.copy_to(partner, caption=text)
+            else:
+                await message.copy_to(partner)
         except Exception:
-            await end_chat(uid, partner)
+            await end_chat(uid, partner, reason="error")
+
+BOT_COMMANDS = [
+    types.BotCommand("start", "Start/Restart"),
+    types.BotCommand("find", "Random Chat"),
+    types.BotCommand("profile", "My Profile"),
+    types.BotCommand("settings", "Edit Profile"),
+    types.BotCommand("premium", "Get Premium"),
+    types.BotCommand("rules", "Read Rules"),
+    types.BotCommand("stop", "Stop Current Chat"),
+    types.BotCommand("next", "Next Chat"),
+    types.BotCommand("shareprofile", "Share Your Profile"),
+]
+
+bot_username = None  # Cached by bootstrap() so handlers never call get_me
+
+async def bootstrap():
+    """Fetch bot identity once and register commands only if they changed."""
+    global bot_username
+    me = await bot.get_me()
+    bot_username = me.username
+
+    wanted = [(c.command, c.description) for c in BOT_COMMANDS]
+    current = [(c.command, c.description) for c in await bot.get_my_commands()]
+    if current != wanted:
+        await bot.set_my_commands(BOT_COMMANDS)
+        logging.info("Bot commands updated")
+
+async def storage_health():
+    store.ping()
+
+async def bot_api_health():
+    await bot.get_me()
+
+metrics.health_checks.update(storage=storage_health, bot_api=bot_api_health)
+
+startup_seconds = None  # Duration of the last create_app()
+metrics.Gauge("chatogram_startup_seconds", "Time create_app took to become ready", lambda: startup_seconds or 0)
+
+async def create_app():
+    """Open storage, migrate it and wait until every dependency is healthy.
+
+    Updates are only accepted after this returns; failed checks are
+    retried with backoff STARTUP_RETRIES times before giving up.
+    """
+    global startup_seconds
+    started = time.perf_counter()
+    for attempt in range(1, STARTUP_RETRIES + 1):
+        try:
+            if store is None:
+                init_storage()
+            for check in metrics.health_checks.values():
+                await check()
+            await bootstrap()
+            break
+        except Exception as e:
+            if attempt == STARTUP_RETRIES:
+                raise
+            logging.warning(f"Startup attempt {attempt} failed: {e}")
+            await asyncio.sleep(min(2 ** attempt, 30))
+    startup_seconds = time.perf_counter() - started
+    logging.info(f"Ready in {startup_seconds * 1000:.0f}ms")
+    return dp
 
 async def on_startup(dp):
+    await create_app()
     if WEBHOOK_URL:
         await bot.set_webhook(WEBHOOK_URL)
     asyncio.create_task(reputation_decay_task())
-    await bot.set_my_commands([
-        types.BotCommand("start", "Start/Restart"),
-        types.BotCommand("find", "Random Chat"),
-        types.BotCommand("profile", "My Profile"),
-        types.BotCommand("settings", "Edit Profile"),
-        types.BotCommand("premium", "Get Premium"),
-        types.BotCommand("rules", "Read Rules"),
-        types.BotCommand("stop", "Stop Current Chat"),
-        types.BotCommand("next", "Next Chat"),
-        types.BotCommand("shareprofile", "Share Your Profile"),
-    ])
+    asyncio.create_task(counters_flush_task())
+    asyncio.create_task(events_flush_task())
+    asyncio.create_task(notification_worker())
+    asyncio.create_task(presence_flush_task())
+    asyncio.create_task(moderation_task())
+    asyncio.create_task(ban_refresh_task())
+    asyncio.create_task(state_sweep_task())
+    if batch_matcher:
+        asyncio.create_task(matching_task())
+    start_broadcast_job()  # Resumes a broadcast interrupted by a restart
+    if METRICS_PORT:
+        await metrics.start_server(int(METRICS_PORT))
+
+async def on_shutdown(dp):
+    event_counters.flush(store)
+    event_log.flush(store)
+    delivery_tracker.flush(store)
+    user_presence.flush(store)
+    moderation_queue.flush(store)
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
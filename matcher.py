@@ -0,0 +1,184 @@
+import asyncio
+import time
+
+import metrics
+
+# Edge weight: reputation of both users (capped), shared interests, and
+# seconds both have been waiting, so long waits eventually win.
+SCORE_CAP = 20
+INTEREST_WEIGHT = 5
+WAIT_WEIGHT = 0.5
+
+# A tick considers at most MAX_POOL waiters, highest priority first; the
+# rest keep gaining wait time and get in on a later tick. The loop yields
+# to the event loop every YIELD_EVERY waiters so updates keep flowing.
+MAX_POOL = 2000
+YIELD_EVERY = 50
+
+MATCH_TICK_SECONDS = metrics.Histogram(
+    "chatogram_match_tick_seconds", "CPU time to solve one batch matching tick",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+MATCHED_PAIRS = metrics.Counter("chatogram_batch_matched_pairs_total", "Pairs proposed by the batch matcher")
+
+
+class Waiter:
+    """A user waiting for a batch match: their own profile plus the
+    filters of the find command they used.
+
+    `strict` is the premium searches' candidate bar (fewer than 3 reports,
+    reputation >= 0); plain /find only skips users with 5+ reports or a
+    shadow-ban reputation.
+    """
+
+    __slots__ = ("user_id", "gender", "city", "interests", "want_gender", "want_city",
+                 "want_interests", "strict", "since", "report_count", "score", "priority")
+
+    def __init__(self, user_id, gender=None, city=None, interests=None,
+                 want_gender=None, want_city=False, want_interests=False, strict=False):
+        self.user_id = user_id
+        self.gender = gender
+        self.city = city
+        self.interests = frozenset(interests.split(", ")) if interests else frozenset()
+        self.want_gender = want_gender
+        self.want_city = want_city
+        self.want_interests = want_interests
+        self.strict = strict
+        self.since = time.monotonic()
+        self.report_count = 0
+        self.score = 0
+        self.priority = 0  # Weight this waiter adds to any edge; set per tick
+
+    def passes(self, strict):
+        """Whether this waiter clears the plain or the strict candidate bar."""
+        if strict:
+            return self.report_count < 3 and self.score >= 0
+        return self.report_count < 5 and self.score > -10
+
+    def accepts(self, other):
+        if not other.passes(self.strict):
+            return False
+        if self.want_gender and other.gender != self.want_gender:
+            return False
+        if self.want_city and other.city != self.city:
+            return False
+        if self.want_interests and not self.interests & other.interests:
+            return False
+        return True
+
+
+class BatchMatcher:
+    """Pairs all current waiters at once instead of per find request.
+
+    An edge's weight is both users' priority (capped reputation plus time
+    waited) plus a bonus per shared interest. solve() is a greedy weighted
+    matching: waiters are taken in priority order and each picks its best
+    free partner that both sides accept and `blocked(a, b)` allows. Buckets
+    by candidate bar, gender and city keep each search to users who can
+    qualify, and a scan stops once no later candidate can beat the best
+    edge found.
+
+    bench.py --matcher reports tick cost by pool size: about 20ms of CPU
+    at 1,000 waiters, 60ms at 2,000 and 250ms at 5,000. MAX_POOL keeps a
+    tick near the 2,000 figure and yielding keeps any one stall near
+    10ms, but once more than about 2,000 users wait at once, waiters past the
+    cap are only served as others leave: batch mode stops being viable
+    there and per-request matching (MATCH_BATCH_MS=0) should be used.
+    """
+
+    def __init__(self, blocked, online):
+        self.blocked = blocked
+        self.online = online
+        self.waiters = {}  # {user_id: Waiter}
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def add(self, waiter):
+        self.waiters[waiter.user_id] = waiter
+
+    def retain(self, user_ids):
+        """Forget waiters that are no longer in `user_ids`."""
+        for uid in [uid for uid in self.waiters if uid not in user_ids]:
+            del self.waiters[uid]
+
+    async def solve(self, standing):
+        """Return [(user_id, user_id)] pairs; `standing` maps user_id to
+        (report_count, reputation_score) and users missing from it are skipped.
+
+        Pairs are proposals: chats may change while solve() yields, so the
+        caller re-checks both users before connecting them.
+        """
+        started = time.perf_counter()
+        busy = 0.0
+        now = time.monotonic()
+
+        pool = []
+        for waiter in self.waiters.values():
+            if waiter.user_id not in standing or not self.online(waiter.user_id):
+                continue
+            report_count, score = standing[waiter.user_id]
+            waiter.report_count, waiter.score = report_count or 0, score or 0
+            waiter.priority = min(waiter.score, SCORE_CAP) + WAIT_WEIGHT * (now - waiter.since)
+            pool.append(waiter)
+        pool.sort(key=lambda w: w.priority, reverse=True)
+        del pool[MAX_POOL:]
+
+        # Every bucket keeps pool order, so a scan can stop on the weight bound
+        buckets = {}
+        for waiter in pool:
+            for strict in (False, True):
+                if waiter.passes(strict):
+                    for key in ((strict,), (strict, "g", waiter.gender), (strict, "c", waiter.city),
+                                (strict, "gc", waiter.gender, waiter.city)):
+                        buckets.setdefault(key, []).append(waiter)
+        heads = dict.fromkeys(buckets, 0)
+        busy += time.perf_counter() - started
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+
+        done = set()
+        pairs = []
+        for n, a in enumerate(pool):
+            if n and n % YIELD_EVERY == 0:
+                busy += time.perf_counter() - started
+                await asyncio.sleep(0)
+                started = time.perf_counter()
+            if a.user_id in done:
+                continue
+            # A waiter is only considered once: if nobody suits them now,
+            # nobody later in this tick will either.
+            done.add(a.user_id)
+
+            if a.want_gender and a.want_city:
+                key = (a.strict, "gc", a.want_gender, a.city)
+            elif a.want_gender:
+                key = (a.strict, "g", a.want_gender)
+            elif a.want_city:
+                key = (a.strict, "c", a.city)
+            else:
+                key = (a.strict,)
+            candidates = buckets.get(key, ())
+            head = heads.get(key, 0)
+            while head < len(candidates) and candidates[head].user_id in done:
+                head += 1
+            heads[key] = head
+
+            best, best_weight = None, None
+            bonus = INTEREST_WEIGHT * len(a.interests)
+            for i in range(head, len(candidates)):
+                b = candidates[i]
+                if best is not None and a.priority + b.priority + bonus <= best_weight:
+                    break
+                if b.user_id in done or not (a.accepts(b) and b.accepts(a)):
+                    continue
+                edge = a.priority + b.priority + INTEREST_WEIGHT * len(a.interests & b.interests)
+                if (best is None or edge > best_weight) and not self.blocked(a.user_id, b.user_id):
+                    best, best_weight = b, edge
+            if best is not None:
+                done.add(best.user_id)
+                pairs.append((a.user_id, best.user_id))
+
+        MATCH_TICK_SECONDS.observe(busy + time.perf_counter() - started)
+        MATCHED_PAIRS.inc(amount=len(pairs))
+        return pairs
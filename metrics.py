@@ -0,0 +1,253 @@
+import logging
+import sys
+import time
+from functools import wraps
+
+import psycopg2.extensions
+from aiogram import Bot
+from aiohttp import web
+
+# =========================
+# METRIC TYPES
+# =========================
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Gauge:
+    """Gauge read at scrape time from a callback, or set explicitly."""
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.value = 0
+        REGISTRY.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def expose(self):
+        value = self.value
+        if self.fn:
+            try:
+                value = self.fn()
+            except Exception as e:
+                logging.error(f"Gauge {self.name} error: {e}")
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # {label_values: [bucket_counts, sum, count]}
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                labels = _format_labels(self.labels, label_values, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, label_values, [("le", "+Inf")])
+            yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+def render():
+    """Render every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+# =========================
+# HOT-PATH METRICS
+# =========================
+
+HANDLER_LATENCY = Histogram(
+    "chatogram_handler_latency_seconds", "Handler latency", labels=("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "chatogram_handler_errors_total", "Unhandled handler exceptions", labels=("handler",)
+)
+DB_QUERY_LATENCY = Histogram(
+    "chatogram_db_query_latency_seconds", "DB query latency", labels=("query",)
+)
+DB_QUERY_ERRORS = Counter(
+    "chatogram_db_query_errors_total", "Failed DB queries", labels=("query",)
+)
+TELEGRAM_LATENCY = Histogram(
+    "chatogram_telegram_api_latency_seconds", "Telegram Bot API call latency", labels=("method",)
+)
+TELEGRAM_ERRORS = Counter(
+    "chatogram_telegram_api_errors_total", "Failed Telegram Bot API calls", labels=("method", "error")
+)
+
+
+def timed(func):
+    """Record latency and errors of an async handler under its function name."""
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+def query_name(query, depth=2):
+    """Name a query after the calling function and its SQL verb, e.g. find_chat:select.
+
+    psycopg2 helpers (execute_values) and private helpers such as
+    Storage._execute_values are skipped, so a batched write is named after
+    the Storage method that issued it.
+    """
+    frame = sys._getframe(depth)
+    while frame.f_back is not None and (
+        frame.f_globals.get("__name__", "").startswith("psycopg2")
+        or (frame.f_code.co_name.startswith("_") and not frame.f_code.co_name.startswith("__"))
+    ):
+        frame = frame.f_back
+    caller = frame.f_code.co_name
+    verb = query.lstrip().split(None, 1)[0].lower() if query.strip() else "empty"
+    return f"{caller}:{verb}"
+
+
+query_listeners = []  # callables(name, elapsed) notified after every query
+
+
+def record_query(name, elapsed):
+    DB_QUERY_LATENCY.observe(elapsed, name)
+    for listener in query_listeners:
+        listener(name, elapsed)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor that times every execute() by query name."""
+
+    def execute(self, query, vars=None):
+        name = query_name(query if isinstance(query, str) else query.decode())
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            DB_QUERY_ERRORS.inc(name)
+            raise
+        finally:
+            record_query(name, time.perf_counter() - start)
+
+
+request_error_listeners = []  # callables(method, data, error) notified of every failed request
+
+
+class InstrumentedBot(Bot):
+    """Bot that times every Bot API request by method."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method, type(e).__name__)
+            for listener in request_error_listeners:
+                listener(method, data, e)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method)
+
+# =========================
+# HTTP ENDPOINT
+# =========================
+
+async def _metrics_view(request):
+    return web.Response(
+        body=render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+health_checks = {}  # {name: async callable raising on failure}, served on /healthz
+
+
+async def _health_view(request):
+    failures = []
+    for name, check in health_checks.items():
+        try:
+            await check()
+        except Exception as e:
+            failures.append(f"{name}: {e}")
+    if failures:
+        return web.Response(status=503, text="\n".join(failures) + "\n")
+    return web.Response(text="ok\n")
+
+
+async def start_server(port, host="0.0.0.0"):
+    """Serve /metrics and /healthz on a background aiohttp site and return its runner."""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    app.router.add_get("/healthz", _health_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,52 @@
+import logging
+from datetime import datetime
+
+import metrics
+
+REPORT_PENALTY = 3  # Reputation lost per report
+
+AUTO_BANS = metrics.Counter("chatogram_auto_bans_total", "Users banned by report thresholds")
+
+
+class ModerationQueue:
+    """Reports buffered by the handler and evaluated in batches by a worker.
+
+    flush() writes the batch to `reports`, applies report_count and
+    reputation changes in one batch, then bans every reported user
+    with at least `threshold` distinct reporters within `window_hours`.
+    """
+
+    def __init__(self, threshold=3, window_hours=24):
+        self.threshold = threshold
+        self.window_hours = window_hours
+        self.pending = []  # (reporter_id, reported_id, reason, reported_at)
+
+    def submit(self, reporter_id, reported_id, reason):
+        self.pending.append((reporter_id, reported_id, reason, datetime.now()))
+
+    # ================= PERSISTENCE =================
+
+    def flush(self, store):
+        """Persist pending reports; return the ids of newly banned users."""
+        reports, self.pending = self.pending, []
+        if not reports:
+            return []
+
+        try:
+            store.add_reports(reports, REPORT_PENALTY)
+        except Exception as e:
+            logging.error(f"Moderation flush error: {e}")
+            self.pending = reports + self.pending  # Retry on the next tick
+            return []
+
+        try:
+            reported = {reported_id for _, reported_id, _, _ in reports}
+            banned = store.auto_ban(reported, self.window_hours, self.threshold)
+        except Exception as e:
+            logging.error(f"Auto-ban evaluation error: {e}")
+            return []
+
+        if banned:
+            AUTO_BANS.inc(amount=len(banned))
+            logging.info(f"AUTO-BAN: {banned}")
+        return banned
@@ -0,0 +1,64 @@
+import logging
+import time
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+class Presence:
+    """Last-seen map fed by incoming updates.
+
+    A user is online if they sent anything within `ttl` seconds. Last-seen
+    times are written to users.last_seen in batches by flush(), so chat
+    start/end no longer write an is_online flag.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.last_seen = {}  # {user_id: unix time}
+        self.dirty = {}      # {user_id: unix time} not yet flushed
+
+    def touch(self, user_id):
+        now = time.time()
+        self.last_seen[user_id] = now
+        self.dirty[user_id] = now
+
+    def is_online(self, user_id):
+        seen = self.last_seen.get(user_id)
+        return seen is not None and time.time() - seen < self.ttl
+
+    def sweep(self):
+        """Drop users idle for longer than the TTL."""
+        cutoff = time.time() - self.ttl
+        expired = [uid for uid, seen in self.last_seen.items() if seen < cutoff]
+        for uid in expired:
+            del self.last_seen[uid]
+        return len(expired)
+
+    def online_count(self):
+        self.sweep()
+        return len(self.last_seen)
+
+    def flush(self, store):
+        dirty, self.dirty = self.dirty, {}
+        self.sweep()
+        if not dirty:
+            return
+        try:
+            store.set_last_seen(dirty)
+        except Exception as e:
+            logging.error(f"Presence flush error: {e}")
+            for uid, seen in dirty.items():
+                self.dirty.setdefault(uid, seen)
+
+
+class PresenceMiddleware(BaseMiddleware):
+    """Marks the sender of every update as seen."""
+
+    def __init__(self, presence):
+        super().__init__()
+        self.presence = presence
+
+    async def on_pre_process_update(self, update, data):
+        event = update.message or update.callback_query or update.pre_checkout_query
+        if event and event.from_user:
+            self.presence.touch(event.from_user.id)
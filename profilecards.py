@@ -0,0 +1,40 @@
+def render(profile):
+    """Partner-facing profile lines shared by match, /shareprofile and /profile."""
+    return (
+        f"🎂 Age: {profile['age']}\n"
+        f"⚧ Gender: {profile['gender']}\n"
+        f"🏙 City: {profile['city']}\n"
+        f"🎯 Interests: {profile['interests'] or 'Not set'}"
+    )
+
+
+class ProfileCards:
+    """Per-user profile fields with their rendered card.
+
+    Profiles are loaded lazily through `loader(uid)`, which returns the
+    profile dict or None, and rendered once. Writers call invalidate()
+    after saving, so the next read reloads and re-renders; showing a
+    partner's card on match costs no query and no formatting.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.cards = {}  # {user_id: (profile, card)}
+
+    def _entry(self, user_id):
+        entry = self.cards.get(user_id)
+        if entry is None:
+            profile = self.loader(user_id)
+            if profile is None:
+                return None, None
+            entry = self.cards[user_id] = (profile, render(profile))
+        return entry
+
+    def profile(self, user_id):
+        return self._entry(user_id)[0]
+
+    def card(self, user_id):
+        return self._entry(user_id)[1]
+
+    def invalidate(self, user_id):
+        self.cards.pop(user_id, None)
@@ -0,0 +1,142 @@
+import contextvars
+import logging
+import os
+from contextlib import contextmanager
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import metrics
+
+# Max queries per update before a warning, overridable per handler:
+# QUERY_BUDGET=10 QUERY_BUDGETS="find_chat=8,start=4"
+DEFAULT_BUDGET = int(os.getenv("QUERY_BUDGET", "10"))
+HANDLER_BUDGETS = {
+    name.strip(): int(limit)
+    for name, limit in (
+        item.split("=", 1) for item in os.getenv("QUERY_BUDGETS", "").split(",") if "=" in item
+    )
+}
+# Same query (caller:verb) repeated more than this within one update is reported as N+1
+REPEAT_LIMIT = int(os.getenv("QUERY_REPEAT_LIMIT", "5"))
+
+QUERIES_PER_UPDATE = metrics.Histogram(
+    "chatogram_db_queries_per_update", "DB queries issued per update", labels=("handler",),
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64)
+)
+BUDGET_EXCEEDED = metrics.Counter(
+    "chatogram_query_budget_exceeded_total", "Updates over their query budget", labels=("handler",)
+)
+
+
+class QueryTracker:
+    """Queries and DB time accumulated by one unit of work."""
+
+    def __init__(self, parent=None):
+        self.parent = parent  # enclosing tracker, e.g. assert_max_queries around a whole update
+        self.queries = 0
+        self.elapsed = 0.0
+        self.by_name = {}  # {query_name: count}
+        self.handler = None
+
+    def record(self, name, elapsed):
+        self.queries += 1
+        self.elapsed += elapsed
+        self.by_name[name] = self.by_name.get(name, 0) + 1
+        if self.parent is not None:
+            self.parent.record(name, elapsed)
+
+    def repeated(self, limit=REPEAT_LIMIT):
+        return {name: n for name, n in self.by_name.items() if n > limit}
+
+    def summary(self):
+        top = sorted(self.by_name.items(), key=lambda x: x[1], reverse=True)
+        return ", ".join(f"{name} x{n}" for name, n in top)
+
+
+_tracker = contextvars.ContextVar("query_tracker", default=None)
+
+
+def record(name, elapsed):
+    tracker = _tracker.get()
+    if tracker is not None:
+        tracker.record(name, elapsed)
+
+
+metrics.query_listeners.append(record)
+
+
+def attribute(handler_name):
+    """Attribute the current update's queries to a handler chosen by a router."""
+    tracker = _tracker.get()
+    if tracker is not None:
+        tracker.handler = handler_name
+
+
+@contextmanager
+def track():
+    """Count the queries run inside the block (and the tasks it awaits)."""
+    tracker = QueryTracker(parent=_tracker.get())
+    token = _tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _tracker.reset(token)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Test helper: fail if the block runs more than `limit` queries.
+
+        with assert_max_queries(4):
+            await main.dp.process_updates([update])
+    """
+    with track() as tracker:
+        yield tracker
+    if tracker.queries > limit:
+        raise AssertionError(
+            f"Expected at most {limit} queries, got {tracker.queries}: {tracker.summary()}"
+        )
+
+
+class QueryBudgetMiddleware(BaseMiddleware):
+    """Tracks DB queries per update and warns when a handler exceeds its budget."""
+
+    async def on_pre_process_update(self, update, data):
+        data["_query_tracker"] = tracker = QueryTracker(parent=_tracker.get())
+        data["_query_tracker_token"] = _tracker.set(tracker)
+
+    async def on_process_message(self, message, data):
+        self._set_handler()
+
+    async def on_process_callback_query(self, callback, data):
+        self._set_handler()
+
+    async def on_process_pre_checkout_query(self, query, data):
+        self._set_handler()
+
+    def _set_handler(self):
+        tracker = _tracker.get()
+        handler = current_handler.get(None)
+        if tracker is not None and handler is not None:
+            tracker.handler = handler.__name__
+
+    async def on_post_process_update(self, update, results, data):
+        tracker = data.pop("_query_tracker", None)
+        token = data.pop("_query_tracker_token", None)
+        if token is not None:
+            _tracker.reset(token)
+        if tracker is None or tracker.handler is None:
+            return
+
+        handler = tracker.handler
+        QUERIES_PER_UPDATE.observe(tracker.queries, handler)
+        budget = HANDLER_BUDGETS.get(handler, DEFAULT_BUDGET)
+        if tracker.queries > budget:
+            BUDGET_EXCEEDED.inc(handler)
+            logging.warning(
+                f"Query budget exceeded: {handler} ran {tracker.queries} queries "
+                f"({tracker.elapsed * 1000:.1f}ms, budget {budget}): {tracker.summary()}"
+            )
+        for name, n in tracker.repeated().items():
+            logging.warning(f"Possible N+1 in {handler}: {name} ran {n} times in one update")
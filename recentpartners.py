@@ -0,0 +1,97 @@
+from array import array
+
+
+class RecentPartners:
+    """The last `size` chat partners of every user, to avoid rematches.
+
+    All rings share one flat array of 64-bit ids, `size` entries per user,
+    plus a 32-bit next write position per user, so a user costs
+    size * 8 + 4 bytes besides their dict entry and a lookup scans at most
+    `size` ids. History comes from `loader(uid, size)` (partner ids, newest
+    first) the first time a user is checked; recording a match never loads.
+
+    At most `max_users` rings are kept (about 3 MB at the defaults); the
+    least recently used one is reused for a new user and reloaded from the
+    DB if that user comes back.
+    """
+
+    def __init__(self, size, loader=None, max_users=100_000):
+        self.size = size
+        self.loader = loader
+        self.max_users = max_users
+        self.slots = {}          # {user_id: slot}, least recently used first
+        self.ring = array("q")   # slot * size .. slot * size + size - 1
+        self.cursor = array("I")
+        self.unloaded = set()    # Users recorded before their history was loaded
+
+    def _new_slot(self, user_id):
+        if len(self.slots) < self.max_users:
+            slot = len(self.cursor)
+            self.ring.frombytes(bytes(8 * self.size))
+            self.cursor.append(0)
+        else:
+            evicted = next(iter(self.slots))
+            slot = self.slots.pop(evicted)
+            self.unloaded.discard(evicted)
+            self._clear(slot)
+        self.slots[user_id] = slot
+        return slot
+
+    def _clear(self, slot):
+        self.ring[slot * self.size:(slot + 1) * self.size] = array("q", bytes(8 * self.size))
+        self.cursor[slot] = 0
+
+    def _use(self, user_id):
+        """The user's slot, marked most recently used; None if they have none."""
+        slot = self.slots.pop(user_id, None)
+        if slot is not None:
+            self.slots[user_id] = slot
+        return slot
+
+    def _push(self, slot, partner_id):
+        pos = self.cursor[slot]
+        self.ring[slot * self.size + pos] = partner_id
+        self.cursor[slot] = (pos + 1) % self.size
+
+    def _entries(self, slot):
+        """Ids in the ring, oldest first."""
+        base, pos = slot * self.size, self.cursor[slot]
+        ids = self.ring[base + pos:base + self.size] + self.ring[base:base + pos]
+        return [i for i in ids if i]
+
+    def _load(self, user_id):
+        slot = self._use(user_id)
+        if slot is None:
+            slot = self._new_slot(user_id)
+            recorded = []
+        else:
+            recorded = self._entries(slot)
+            self._clear(slot)
+        self.unloaded.discard(user_id)
+        history = self.loader(user_id, self.size) if self.loader else []
+        # Recorded matches may already be flushed into the history; keep each
+        # partner once, at its newest position, so the window stays `size` wide
+        newest_first = dict.fromkeys(list(reversed(recorded)) + list(history))
+        for partner_id in reversed(list(newest_first)[:self.size]):
+            self._push(slot, partner_id)
+        return slot
+
+    def add(self, user1, user2):
+        """Record that user1 and user2 were just connected."""
+        if not self.size:
+            return
+        for uid, partner in ((user1, user2), (user2, user1)):
+            slot = self._use(uid)
+            if slot is None:
+                slot = self._new_slot(uid)
+                self.unloaded.add(uid)
+            self._push(slot, partner)
+
+    def contains(self, user_id, other):
+        """True if `other` is among user_id's last `size` partners."""
+        if not self.size:
+            return False
+        slot = self._use(user_id)
+        if slot is None or user_id in self.unloaded:
+            slot = self._load(user_id)
+        return other in self.ring[slot * self.size:(slot + 1) * self.size]
@@ -0,0 +1,162 @@
+import os
+import re
+
+import metrics
+
+BLOCK = "block"
+MASK = "mask"
+FLAG = "flag"
+
+# Most severe action wins when a message matches several categories
+SEVERITY = {FLAG: 1, MASK: 2, BLOCK: 3}
+
+MASK_TEXT = "***"
+
+# card comes before phone: a long digit run is tried as a card number first.
+# Phone numbers need a phone shape, not just enough digits, so dates, times,
+# scores and ids pass: +country code, (area) code, 3-3-4 groups or a
+# national number starting with 0.
+PATTERNS = {
+    "link": r"(?i:https?://|www\.|t\.me/|telegram\.me/)\S+",
+    "card": r"(?<!\d)\d(?:[ \-]?\d){12,18}(?!\d)",
+    "phone": (
+        r"(?<![\w+])(?:\+\d(?:[ \-()]{0,2}\d){7,14}"
+        r"|\(\d{2,4}\)[ \-]?\d{3,4}[ \-]?\d{3,4}"
+        r"|\d{3}[ \-.]\d{3}[ \-.]\d{4}"
+        r"|0\d{9,11})(?!\w)"
+    ),
+}
+
+DEFAULT_ACTIONS = {"word": MASK, "link": FLAG, "phone": BLOCK, "card": BLOCK}
+
+RELAY_FILTERED = metrics.Counter(
+    "chatogram_relay_filtered_total", "Relayed messages caught by the filter", labels=("category", "action")
+)
+
+
+def _trie_pattern(words):
+    """Regex for a word list, factored into a trie so matching cost does
+    not grow with the number of words."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        end = "" in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        group = "(?:" + "|".join(branches) + ")"
+        return group + "?" if end else group
+
+    return build(trie)
+
+
+def _luhn(digits):
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return total % 10 == 0
+
+
+class RelayFilter:
+    """Single compiled pass over relayed text for banned words, links,
+    phone numbers and card numbers.
+
+    `actions` maps a category (word, link, phone, card) to block, mask or
+    flag; categories missing from it are not checked. Clean text costs a
+    single regex scan.
+    """
+
+    def __init__(self, words=(), actions=None):
+        actions = dict(DEFAULT_ACTIONS if actions is None else actions)
+        words = sorted({w.strip().lower() for w in words if w.strip()})
+        if not words:
+            actions.pop("word", None)
+        self.actions = actions
+
+        parts = []
+        if "word" in actions:
+            parts.append(rf"(?P<word>\b(?i:{_trie_pattern(words)})\b)")
+        for category, pattern in PATTERNS.items():
+            if category in actions:
+                parts.append(f"(?P<{category}>{pattern})")
+        self.pattern = re.compile("|".join(parts)) if parts else None
+        self.phone = re.compile(PATTERNS["phone"])
+
+    def check(self, text):
+        """Return (action, text, categories); action is None if clean."""
+        if not text or self.pattern is None:
+            return None, text, []
+
+        action = None
+        categories = []
+        masked = []
+        for match in self.pattern.finditer(text):
+            category = match.lastgroup
+            if category == "card":
+                digits = re.sub(r"\D", "", match.group())
+                if not _luhn(digits):
+                    # Not a card; still a phone number if it is shaped like one
+                    if "phone" not in self.actions or not self.phone.search(match.group()):
+                        continue
+                    category = "phone"
+            categories.append(category)
+            hit = self.actions[category]
+            if hit == MASK:
+                masked.append(match.span())
+            if action is None or SEVERITY[hit] > SEVERITY[action]:
+                action = hit
+
+        for category in categories:
+            RELAY_FILTERED.inc(category, self.actions[category])
+
+        if action == MASK:
+            parts, pos = [], 0
+            for start, end in masked:
+                parts.append(text[pos:start])
+                parts.append(MASK_TEXT)
+                pos = end
+            parts.append(text[pos:])
+            text = "".join(parts)
+        return action, text, categories
+
+
+def from_env():
+    """Build the filter from the environment, or None if it is disabled.
+
+    RELAY_FILTER=on uses DEFAULT_ACTIONS; RELAY_FILTER="word=mask,card=block"
+    checks only the listed categories. RELAY_FILTER_WORDS is a file with one
+    word or phrase per line.
+    """
+    spec = os.getenv("RELAY_FILTER", "").strip()
+    if not spec or spec.lower() in ("0", "off", "false"):
+        return None
+
+    actions = None
+    if "=" in spec:
+        actions = {
+            category.strip(): action.strip()
+            for category, action in (item.split("=", 1) for item in spec.split(",") if "=" in item)
+        }
+        unknown = {a for a in actions.values() if a not in SEVERITY}
+        if unknown:
+            raise ValueError(f"RELAY_FILTER: unknown action(s) {', '.join(sorted(unknown))}")
+
+    words = []
+    path = os.getenv("RELAY_FILTER_WORDS")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            words = [line for line in f.read().splitlines() if line and not line.startswith("#")]
+
+    return RelayFilter(words, actions)
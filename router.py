@@ -0,0 +1,94 @@
+from aiogram import types
+from aiogram.types import ContentType
+
+import querybudget
+
+
+class Router:
+    """Front router for messages.
+
+    Instead of walking aiogram's handler list and evaluating every filter,
+    a message is resolved with a few dict lookups, in this order:
+
+    1. content type (e.g. successful payments)
+    2. exact command (/start, /find ...)
+    3. exact button text
+    4. per-user state (user_id in a state mapping), text messages only
+    5. the fallback handler (chat relay)
+    """
+
+    def __init__(self):
+        self.content_types = {}  # {content_type: handler}
+        self.commands = {}       # {command: handler}
+        self.texts = {}          # {button text: handler}
+        self.states = []         # [(mapping, handler)] checked in order
+        self.fallback = None
+
+    # ================= REGISTRATION =================
+
+    def content_type(self, *content_types):
+        def decorator(handler):
+            for content_type in content_types:
+                self.content_types[content_type] = handler
+            return handler
+        return decorator
+
+    def command(self, *commands):
+        def decorator(handler):
+            for command in commands:
+                self.commands[command.lower()] = handler
+            return handler
+        return decorator
+
+    def text(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                self.texts[text] = handler
+            return handler
+        return decorator
+
+    def state(self, mapping):
+        """Route text from users whose id is a key of `mapping`."""
+        def decorator(handler):
+            self.states.append((mapping, handler))
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self.fallback = handler
+        return handler
+
+    def register(self, dp):
+        dp.register_message_handler(self.dispatch, content_types=ContentType.ANY)
+
+    # ================= DISPATCH =================
+
+    def resolve(self, message: types.Message):
+        handler = self.content_types.get(message.content_type)
+        if handler:
+            return handler
+
+        text = message.text
+        if text is not None:
+            if text.startswith("/"):
+                handler = self.commands.get(message.get_command(pure=True).lower())
+                if handler:
+                    return handler
+
+            handler = self.texts.get(text)
+            if handler:
+                return handler
+
+            uid = message.from_user.id
+            for mapping, handler in self.states:
+                if uid in mapping:
+                    return handler
+
+        return self.fallback
+
+    async def dispatch(self, message: types.Message):
+        handler = self.resolve(message)
+        if handler is None:
+            return
+        querybudget.attribute(handler.__name__)
+        return await handler(message)
@@ -0,0 +1,1137 @@
+import abc
+import logging
+import time
+from datetime import date, datetime, timedelta
+from functools import wraps
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import metrics
+
+# Profile fields handlers may write; anything else is rejected
+PROFILE_FIELDS = ("age", "gender", "city", "country", "interests")
+
+# (referred_by, referral_completed, age, gender, city, interests), returned by
+# profile writes so the referral check can usually skip its statement
+REFERRAL_CHECK_COLUMNS = "referred_by, referral_completed, age, gender, city, interests"
+
+REFERRAL_TIERS = {1: timedelta(minutes=30), 3: timedelta(hours=3), 5: timedelta(days=1), 10: timedelta(days=3)}
+
+# Lifetime totals that predate the counters are backfilled under this day
+BASELINE_DAY = date(1970, 1, 1)
+
+TRIAL_HOURS = 2  # Free premium for new users
+
+# /export name -> table; only these can be exported
+EXPORT_TABLES = {"users": "users", "reports": "reports", "matches": "matches", "events": "chat_events"}
+EXPORT_BATCH = 2000  # Rows per server-side cursor fetch
+
+
+def connect(url):
+    """Open the backend selected by `url`: memory:// or a Postgres DSN."""
+    if url == "memory://":
+        return MemoryStorage()
+    return PostgresStorage(url)
+
+
+class Storage(abc.ABC):
+    """Every read and write the bot makes, behind one interface.
+
+    PostgresStorage is the production backend. MemoryStorage keeps the same
+    data in dicts so the bot can be started and profiled without a database.
+    Every method is abstract: a backend missing one fails when it is created.
+    """
+
+    @abc.abstractmethod
+    def setup(self):
+        """Create or upgrade the schema."""
+
+    @abc.abstractmethod
+    def ping(self):
+        """Raise if the backend is unreachable."""
+
+    # ================= USERS =================
+
+    @abc.abstractmethod
+    def user_exists(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def create_user(self, user_id, username="", referred_by=None, trial_hours=0):
+        """Insert a blank profile; returns False if the user already exists."""
+
+    @abc.abstractmethod
+    def get_profile(self, user_id):
+        """dict of PROFILE_FIELDS plus premium_until, or None."""
+
+    @abc.abstractmethod
+    def get_premium_until(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def save_profile(self, user_id, **fields):
+        """Upsert profile fields; returns the REFERRAL_CHECK_COLUMNS row."""
+
+    @abc.abstractmethod
+    def find_candidates(self, user_id, gender=None, city=None, with_interests=False):
+        """Unbanned, reachable users other than user_id as
+        (user_id, report_count, reputation_score, interests) rows."""
+
+    @abc.abstractmethod
+    def get_standing(self, user_ids):
+        """{user_id: (report_count, reputation_score)} for unbanned users."""
+
+    @abc.abstractmethod
+    def update_reputation(self, user_id, delta):
+        ...
+
+    @abc.abstractmethod
+    def decay_reputation(self):
+        ...
+
+    @abc.abstractmethod
+    def set_last_partners(self, user1, user2):
+        ...
+
+    @abc.abstractmethod
+    def get_last_partner(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def recent_partners(self, user_id, limit):
+        """Up to `limit` partners from the matches history, newest first."""
+
+    @abc.abstractmethod
+    def block_lists(self, user_id):
+        """(users user_id blocked, users who blocked user_id)."""
+
+    @abc.abstractmethod
+    def add_block(self, user_id, blocked_id):
+        ...
+
+    @abc.abstractmethod
+    def complete_referral(self, user_id):
+        """Mark a full profile's referral complete and reward the referrer.
+
+        Returns (referrer_id, referral_count, reward or None), or None if
+        there was nothing to complete.
+        """
+
+    @abc.abstractmethod
+    def extend_premium(self, user_id, days):
+        """Add days from now or the current expiry, whichever is later;
+        returns the new expiry (None if the user does not exist)."""
+
+    @abc.abstractmethod
+    def record_payment(self, charge_id, user_id, days, payload, currency, amount):
+        """Ledger a payment and extend premium by `days`, once per charge_id.
+
+        Returns the new expiry, or None if the charge was already recorded.
+        Raises LookupError, recording nothing, if the user does not exist.
+        """
+
+    @abc.abstractmethod
+    def set_premium_until(self, user_id, until):
+        ...
+
+    @abc.abstractmethod
+    def set_last_seen(self, seen):
+        """Write {user_id: unix time} last-seen times."""
+
+    # ================= BANS =================
+
+    @abc.abstractmethod
+    def load_bans(self):
+        """(set of banned user ids, last ban_log id)."""
+
+    @abc.abstractmethod
+    def ban_changes(self, since):
+        """[(log_id, user_id, banned)] after `since`, oldest first."""
+
+    @abc.abstractmethod
+    def is_banned(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def ban(self, user_id, reason=""):
+        """Returns False if the user was already banned."""
+
+    @abc.abstractmethod
+    def unban(self, user_id):
+        ...
+
+    # ================= REPORTS =================
+
+    @abc.abstractmethod
+    def add_reports(self, reports, penalty):
+        """Store (reporter_id, reported_id, reason, reported_at) rows and apply
+        report_count and `penalty` reputation per report."""
+
+    @abc.abstractmethod
+    def auto_ban(self, user_ids, window_hours, threshold):
+        """Ban users among user_ids with `threshold` distinct reporters within
+        the window; returns the newly banned ids."""
+
+    # ================= MATCHES & EVENTS =================
+
+    @abc.abstractmethod
+    def add_matches(self, matches):
+        """(user1, user2, matched_at, ended_at, duration, end_reason) rows."""
+
+    @abc.abstractmethod
+    def add_chat_events(self, events):
+        """(event, user_id, partner_id, duration, created_at) rows."""
+
+    # ================= COUNTERS =================
+
+    @abc.abstractmethod
+    def load_counters(self, day):
+        """({name: all-time total}, {name: value on day}, {active user ids on day})."""
+
+    @abc.abstractmethod
+    def add_counters(self, deltas, active):
+        """Add {(day, name): delta} and record (day, user_id) activity."""
+
+    # ================= BROADCASTS =================
+
+    @abc.abstractmethod
+    def create_broadcast(self, text):
+        """Start a broadcast; returns its id."""
+
+    @abc.abstractmethod
+    def active_broadcast(self):
+        """(id, text, last_user_id, sent, failed) of the unfinished broadcast, or None."""
+
+    @abc.abstractmethod
+    def broadcast_recipients(self, after_user_id, limit):
+        """Up to `limit` reachable, unbanned user ids above after_user_id, ascending."""
+
+    @abc.abstractmethod
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, finished=False):
+        """Record progress; finished=True ends the broadcast, and a finished
+        broadcast stays finished."""
+
+    @abc.abstractmethod
+    def mark_unreachable(self, user_ids):
+        """Flag users the bot can no longer message."""
+
+    @abc.abstractmethod
+    def mark_reachable(self, user_ids):
+        ...
+
+    @abc.abstractmethod
+    def unreachable_users(self):
+        """Ids of every user flagged unreachable."""
+
+    # ================= EXPORT =================
+
+    @abc.abstractmethod
+    def export_rows(self, name):
+        """Stream an EXPORT_TABLES table: yields its column names, then rows.
+
+        Safe to run in a worker thread; it does not use the bot's connection.
+        """
+
+
+def _counted_calls(cls):
+    """Report each public method call as one query named method:memory, so
+    query metrics and budgets work on memory:// as they do on Postgres.
+    Calls a method makes to other methods of the store are not counted."""
+
+    def counted(name, method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._in_call:
+                return method(self, *args, **kwargs)
+            self._in_call = True
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._in_call = False
+                metrics.record_query(f"{name}:memory", time.perf_counter() - start)
+        return wrapper
+
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith("_"):
+            setattr(cls, name, counted(name, method))
+    return cls
+
+
+@_counted_calls
+class MemoryStorage(Storage):
+    """In-process backend for benchmarks and tests; nothing is persisted."""
+
+    _in_call = False
+
+    def __init__(self):
+        self.users = {}     # {user_id: {column: value}}
+        self.bans = {}      # {user_id: (banned_at, reason)}
+        self.ban_log = []   # [(log_id, user_id, banned)]
+        self.reports = []   # [(reporter_id, reported_id, reason, reported_at)]
+        self.matches = []
+        self.chat_events = []
+        self.rollup = {}    # {(day, name): value}
+        self.daily_active = set()  # {(day, user_id)}
+        self.payments = {}  # {charge_id: (user_id, days, payload, currency, amount, paid_at)}
+        self.broadcasts = {}  # {id: [text, last_user_id, sent, failed, finished]}
+
+    def setup(self):
+        pass
+
+    def ping(self):
+        pass
+
+    # ================= USERS =================
+
+    def user_exists(self, user_id):
+        return user_id in self.users
+
+    def create_user(self, user_id, username="", referred_by=None, trial_hours=0):
+        if user_id in self.users:
+            return False
+        self.users[user_id] = {
+            "username": username, "age": 0, "gender": "", "city": "", "country": "", "interests": "",
+            "blocked_users": [], "banned": False, "report_count": 0, "reputation_score": 0,
+            "premium_until": datetime.now() + timedelta(hours=trial_hours) if trial_hours else None,
+            "last_chat_user_id": None, "last_seen": None, "unreachable": False,
+            "referred_by": referred_by, "referral_count": 0, "referral_completed": False,
+            "joined_at": int(time.time()),
+        }
+        return True
+
+    def get_profile(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        return {field: user[field] for field in PROFILE_FIELDS + ("premium_until",)}
+
+    def get_premium_until(self, user_id):
+        user = self.users.get(user_id)
+        return user["premium_until"] if user else None
+
+    def save_profile(self, user_id, **fields):
+        if set(fields) - set(PROFILE_FIELDS):
+            raise ValueError(f"Unknown profile fields: {set(fields) - set(PROFILE_FIELDS)}")
+        self.create_user(user_id)
+        user = self.users[user_id]
+        user.update(fields)
+        return tuple(user[c.strip()] for c in REFERRAL_CHECK_COLUMNS.split(","))
+
+    def find_candidates(self, user_id, gender=None, city=None, with_interests=False):
+        return [
+            (uid, u["report_count"], u["reputation_score"], u["interests"])
+            for uid, u in self.users.items()
+            if uid != user_id and not u["banned"] and not u["unreachable"]
+            and (gender is None or u["gender"] == gender)
+            and (city is None or u["city"] == city)
+            and (not with_interests or u["interests"])
+        ]
+
+    def get_standing(self, user_ids):
+        return {
+            uid: (u["report_count"], u["reputation_score"])
+            for uid, u in ((uid, self.users.get(uid)) for uid in user_ids)
+            if u and not u["banned"]
+        }
+
+    def update_reputation(self, user_id, delta):
+        user = self.users.get(user_id)
+        if user:
+            user["reputation_score"] += delta
+
+    def decay_reputation(self):
+        for user in self.users.values():
+            user["reputation_score"] = max(0, user["reputation_score"] - 1)
+
+    def set_last_partners(self, user1, user2):
+        for uid, partner in ((user1, user2), (user2, user1)):
+            if uid in self.users:
+                self.users[uid]["last_chat_user_id"] = partner
+
+    def get_last_partner(self, user_id):
+        user = self.users.get(user_id)
+        return user["last_chat_user_id"] if user else None
+
+    def recent_partners(self, user_id, limit):
+        partners = [
+            (matched_at, user2 if user1 == user_id else user1)
+            for user1, user2, matched_at, *_ in self.matches
+            if user_id in (user1, user2)
+        ]
+        return [partner for _, partner in sorted(partners, reverse=True)[:limit]]
+
+    def block_lists(self, user_id):
+        user = self.users.get(user_id)
+        blocked = list(user["blocked_users"]) if user else []
+        blocked_by = [uid for uid, u in self.users.items() if user_id in u["blocked_users"]]
+        return blocked, blocked_by
+
+    def add_block(self, user_id, blocked_id):
+        user = self.users.get(user_id)
+        if user and blocked_id not in user["blocked_users"]:
+            user["blocked_users"].append(blocked_id)
+
+    def complete_referral(self, user_id):
+        user = self.users.get(user_id)
+        if (not user or not user["referred_by"] or user["referral_completed"]
+                or not (user["age"] and user["gender"] and user["city"] and user["interests"])):
+            return None
+        user["referral_completed"] = True
+        referrer = self.users.get(user["referred_by"])
+        if referrer is None:
+            return None
+        referrer["referral_count"] += 1
+        reward = REFERRAL_TIERS.get(referrer["referral_count"])
+        if reward:
+            now = datetime.now()
+            referrer["premium_until"] = max(referrer["premium_until"] or now, now) + reward
+        return user["referred_by"], referrer["referral_count"], reward
+
+    def extend_premium(self, user_id, days):
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        now = datetime.now()
+        user["premium_until"] = max(user["premium_until"] or now, now) + timedelta(days=days)
+        return user["premium_until"]
+
+    def record_payment(self, charge_id, user_id, days, payload, currency, amount):
+        if user_id not in self.users:
+            raise LookupError(f"Unknown user {user_id}")
+        if charge_id in self.payments:
+            return None
+        self.payments[charge_id] = (user_id, days, payload, currency, amount, datetime.now())
+        return self.extend_premium(user_id, days)
+
+    def set_premium_until(self, user_id, until):
+        user = self.users.get(user_id)
+        if user:
+            user["premium_until"] = until
+
+    def set_last_seen(self, seen):
+        for uid, ts in seen.items():
+            if uid in self.users:
+                self.users[uid]["last_seen"] = datetime.fromtimestamp(ts)
+
+    # ================= BANS =================
+
+    def _log_ban(self, user_id, banned):
+        self.ban_log.append((len(self.ban_log) + 1, user_id, banned))
+        if user_id in self.users:
+            self.users[user_id]["banned"] = banned
+
+    def load_bans(self):
+        return set(self.bans), len(self.ban_log)
+
+    def ban_changes(self, since):
+        return self.ban_log[since:]
+
+    def is_banned(self, user_id):
+        return user_id in self.bans
+
+    def ban(self, user_id, reason=""):
+        if user_id in self.bans:
+            return False
+        self.bans[user_id] = (int(time.time()), reason)
+        self._log_ban(user_id, True)
+        return True
+
+    def unban(self, user_id):
+        if self.bans.pop(user_id, None) is not None:
+            self._log_ban(user_id, False)
+
+    # ================= REPORTS =================
+
+    def add_reports(self, reports, penalty):
+        self.reports.extend(reports)
+        for _, reported_id, _, _ in reports:
+            user = self.users.get(reported_id)
+            if user:
+                user["report_count"] += 1
+                user["reputation_score"] -= penalty
+
+    def auto_ban(self, user_ids, window_hours, threshold):
+        since = datetime.now() - timedelta(hours=window_hours)
+        reporters = {}
+        for reporter_id, reported_id, _, reported_at in self.reports:
+            if reported_id in user_ids and reported_at > since:
+                reporters.setdefault(reported_id, set()).add(reporter_id)
+        return [
+            uid for uid, who in reporters.items()
+            if len(who) >= threshold and self.ban(uid, "reports")
+        ]
+
+    # ================= MATCHES & EVENTS =================
+
+    def add_matches(self, matches):
+        self.matches.extend(matches)
+
+    def add_chat_events(self, events):
+        self.chat_events.extend(events)
+
+    # ================= COUNTERS =================
+
+    def load_counters(self, day):
+        totals, daily = {}, {}
+        for (d, name), value in self.rollup.items():
+            totals[name] = totals.get(name, 0) + value
+            if d == day:
+                daily[name] = value
+        active = {uid for d, uid in self.daily_active if d == day}
+        return totals, daily, active
+
+    def add_counters(self, deltas, active):
+        for key, delta in deltas.items():
+            self.rollup[key] = self.rollup.get(key, 0) + delta
+        self.daily_active.update(active)
+
+    # ================= BROADCASTS =================
+
+    def create_broadcast(self, text):
+        broadcast_id = len(self.broadcasts) + 1
+        self.broadcasts[broadcast_id] = [text, 0, 0, 0, False]
+        return broadcast_id
+
+    def active_broadcast(self):
+        for broadcast_id, (text, last_user_id, sent, failed, finished) in self.broadcasts.items():
+            if not finished:
+                return broadcast_id, text, last_user_id, sent, failed
+        return None
+
+    def broadcast_recipients(self, after_user_id, limit):
+        return sorted(
+            uid for uid, u in self.users.items()
+            if uid > after_user_id and not u["unreachable"] and uid not in self.bans
+        )[:limit]
+
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, finished=False):
+        broadcast = self.broadcasts[broadcast_id]
+        broadcast[1:] = [last_user_id, sent, failed, finished or broadcast[4]]
+
+    def mark_unreachable(self, user_ids):
+        for uid in user_ids:
+            if uid in self.users:
+                self.users[uid]["unreachable"] = True
+
+    def mark_reachable(self, user_ids):
+        for uid in user_ids:
+            if uid in self.users:
+                self.users[uid]["unreachable"] = False
+
+    def unreachable_users(self):
+        return {uid for uid, user in self.users.items() if user["unreachable"]}
+
+    # ================= EXPORT =================
+
+    EXPORT_COLUMNS = {
+        "reports": ("reporter_id", "reported_id", "reason", "reported_at"),
+        "matches": ("user1", "user2", "matched_at", "ended_at", "duration", "end_reason"),
+        "events": ("event", "user_id", "partner_id", "duration", "created_at"),
+    }
+
+    def export_rows(self, name):
+        if name == "users":
+            users = list(self.users.items())
+            columns = list(users[0][1]) if users else []
+            yield ["user_id"] + columns
+            for uid, user in users:
+                yield [uid] + [user[c] for c in columns]
+            return
+        yield self.EXPORT_COLUMNS[name]
+        yield from list({"reports": self.reports, "matches": self.matches, "events": self.chat_events}[name])
+
+
+# ================= POSTGRES =================
+
+SCHEMA = """
+ALTER TABLE users ADD COLUMN IF NOT EXISTS reputation_score INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referred_by BIGINT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_completed BOOLEAN DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP;
+CREATE INDEX IF NOT EXISTS users_blocked_users_gin ON users USING GIN (blocked_users);
+
+CREATE TABLE IF NOT EXISTS referral_tiers (
+    referrals INTEGER PRIMARY KEY,
+    reward INTERVAL NOT NULL
+);
+INSERT INTO referral_tiers (referrals, reward) VALUES
+    (1, INTERVAL '30 minutes'), (3, INTERVAL '3 hours'),
+    (5, INTERVAL '1 day'), (10, INTERVAL '3 days')
+ON CONFLICT (referrals) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS stats_rollup (
+    day DATE NOT NULL,
+    name TEXT NOT NULL,
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, name)
+);
+CREATE TABLE IF NOT EXISTS daily_active (
+    day DATE NOT NULL,
+    user_id BIGINT NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+
+-- matches predates the event log; it gains the end of the chat lifecycle.
+-- chat_events is append-only and range-partitioned by month.
+CREATE TABLE IF NOT EXISTS matches (
+    id SERIAL PRIMARY KEY,
+    user1 BIGINT,
+    user2 BIGINT,
+    matched_at BIGINT
+);
+ALTER TABLE matches ADD COLUMN IF NOT EXISTS ended_at BIGINT;
+ALTER TABLE matches ADD COLUMN IF NOT EXISTS duration INTEGER;
+ALTER TABLE matches ADD COLUMN IF NOT EXISTS end_reason TEXT;
+CREATE INDEX IF NOT EXISTS matches_user1_idx ON matches (user1, matched_at);
+CREATE INDEX IF NOT EXISTS matches_user2_idx ON matches (user2, matched_at);
+
+CREATE TABLE IF NOT EXISTS chat_events (
+    event TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    partner_id BIGINT,
+    duration REAL,
+    created_at TIMESTAMP NOT NULL
+) PARTITION BY RANGE (created_at);
+CREATE INDEX IF NOT EXISTS chat_events_user_idx ON chat_events (user_id, created_at);
+
+-- bans is the source of truth. A trigger appends every ban and
+-- unban to ban_log and mirrors it into users.banned, which the candidate
+-- queries filter on, so direct SQL is picked up too.
+CREATE TABLE IF NOT EXISTS bans (
+    user_id BIGINT PRIMARY KEY,
+    banned_at BIGINT,
+    reason TEXT
+);
+CREATE TABLE IF NOT EXISTS ban_log (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    banned BOOLEAN NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION bans_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO ban_log (user_id, banned) VALUES (NEW.user_id, true);
+        UPDATE users SET banned = true WHERE user_id = NEW.user_id;
+    ELSE
+        INSERT INTO ban_log (user_id, banned) VALUES (OLD.user_id, false);
+        UPDATE users SET banned = false WHERE user_id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS bans_changed ON bans;
+CREATE TRIGGER bans_changed AFTER INSERT OR DELETE ON bans
+    FOR EACH ROW EXECUTE FUNCTION bans_changed();
+
+-- Bans made through the old users.banned flag
+INSERT INTO bans (user_id, banned_at, reason)
+SELECT user_id, EXTRACT(EPOCH FROM NOW())::BIGINT, 'migrated' FROM users WHERE banned
+ON CONFLICT (user_id) DO NOTHING;
+
+-- reports lookups are per reported user and time window.
+CREATE TABLE IF NOT EXISTS reports (
+    id SERIAL PRIMARY KEY,
+    reporter_id BIGINT,
+    reported_id BIGINT,
+    reason TEXT,
+    reported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS reports_reported_idx ON reports (reported_id, reported_at);
+"""
+
+# Users table for fresh databases; columns dp.py's older table lacks are added
+USERS_TABLE = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    age INT,
+    gender TEXT,
+    city TEXT,
+    country TEXT,
+    interests TEXT,
+    blocked_users BIGINT[] DEFAULT '{}',
+    is_premium BOOLEAN DEFAULT FALSE,
+    premium_until TIMESTAMP,
+    joined_at BIGINT,
+    banned BOOLEAN DEFAULT FALSE,
+    report_count INTEGER DEFAULT 0,
+    last_chat_user_id BIGINT,
+    is_online BOOLEAN DEFAULT FALSE
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS interests TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_users BIGINT[] DEFAULT '{}';
+ALTER TABLE users ADD COLUMN IF NOT EXISTS banned BOOLEAN DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS report_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_chat_user_id BIGINT;
+"""
+
+# Applied in order, each once, tracked in schema_version. Append new steps;
+# never edit one that has shipped. Version 1 is the schema main.py already
+# ensured on every start before versioning; it is idempotent, so existing
+# databases just get it recorded.
+MIGRATIONS = [
+    USERS_TABLE + SCHEMA,
+    """
+    CREATE TABLE payments (
+        telegram_payment_charge_id TEXT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        days INTEGER NOT NULL,
+        payload TEXT,
+        currency TEXT,
+        total_amount INTEGER,
+        paid_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    CREATE INDEX payments_user_idx ON payments (user_id, paid_at);
+    """,
+    """
+    ALTER TABLE users ADD COLUMN unreachable BOOLEAN NOT NULL DEFAULT false;
+    CREATE TABLE broadcasts (
+        id SERIAL PRIMARY KEY,
+        text TEXT NOT NULL,
+        last_user_id BIGINT NOT NULL DEFAULT 0,  -- Keyset cursor: everyone up to here was tried
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        finished_at TIMESTAMP
+    );
+    """,
+]
+
+SCHEMA_LOCK_ID = 7301  # pg_advisory_xact_lock key: one migrator at a time
+
+# One atomic statement: mark the referral complete (only once, only for a full
+# profile), bump the referrer's count and stack the tier reward, if any.
+REFERRAL_REWARD_SQL = """
+    WITH done AS (
+        UPDATE users SET referral_completed = TRUE
+        WHERE user_id = %s
+          AND referred_by IS NOT NULL
+          AND NOT COALESCE(referral_completed, FALSE)
+          AND COALESCE(age, 0) > 0 AND COALESCE(gender, '') <> ''
+          AND COALESCE(city, '') <> '' AND COALESCE(interests, '') <> ''
+        RETURNING referred_by
+    )
+    UPDATE users u
+    SET referral_count = COALESCE(u.referral_count, 0) + 1,
+        premium_until = COALESCE(
+            GREATEST(COALESCE(u.premium_until, NOW()), NOW())
+                + (SELECT t.reward FROM referral_tiers t WHERE t.referrals = COALESCE(u.referral_count, 0) + 1),
+            u.premium_until
+        )
+    FROM done
+    WHERE u.user_id = done.referred_by
+    RETURNING u.user_id, u.referral_count,
+        (SELECT t.reward FROM referral_tiers t WHERE t.referrals = u.referral_count)
+"""
+
+
+def _month_start(ts):
+    return datetime(ts.year, ts.month, 1)
+
+
+def _next_month(ts):
+    return datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1)
+
+
+class PostgresStorage(Storage):
+    """Production backend on one autocommit psycopg2 connection."""
+
+    def __init__(self, url):
+        self.url = url
+        self.conn = psycopg2.connect(url)
+        self.conn.autocommit = True
+        self.cur = self.conn.cursor(cursor_factory=metrics.InstrumentedCursor)
+        self.partitions = set()
+
+    def _schema_version(self):
+        self.cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not self.cur.fetchone()[0]:
+            return 0
+        self.cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return self.cur.fetchone()[0]
+
+    def setup(self):
+        """Apply pending MIGRATIONS; a current schema costs two queries."""
+        if self._schema_version() >= len(MIGRATIONS):
+            return
+
+        self.conn.autocommit = False
+        try:
+            with self.conn:
+                self.cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+                self.cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)")
+                current = self._schema_version()  # Another instance may have migrated meanwhile
+                for version, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+                    logging.info(f"Applying schema migration {version}")
+                    self.cur.execute(migration)
+                    self.cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+        finally:
+            self.conn.autocommit = True
+
+    def ping(self):
+        self.cur.execute("SELECT 1")
+        self.cur.fetchone()
+
+    def _ensure_partition(self, ts):
+        start = _month_start(ts)
+        if start in self.partitions:
+            return
+        name = f"chat_events_{start:%Y_%m}"
+        self.cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF chat_events "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            (start, _next_month(start))
+        )
+        self.partitions.add(start)
+
+    def _execute_values(self, query, rows):
+        execute_values(self.cur, query, rows, page_size=1000)
+
+    # ================= USERS =================
+
+    def user_exists(self, user_id):
+        self.cur.execute("SELECT 1 FROM users WHERE user_id=%s", (user_id,))
+        return self.cur.fetchone() is not None
+
+    def create_user(self, user_id, username="", referred_by=None, trial_hours=0):
+        self.cur.execute("""
+            INSERT INTO users (user_id, username, age, gender, city, country, interests, blocked_users,
+                               premium_until, referred_by, joined_at)
+            VALUES (%s, %s, 0, '', '', '', '', '{}', CASE WHEN %s > 0 THEN NOW() + make_interval(hours => %s) END, %s,
+                    EXTRACT(EPOCH FROM NOW())::BIGINT)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
+        """, (user_id, username, trial_hours, trial_hours, referred_by))
+        return self.cur.fetchone() is not None
+
+    def get_profile(self, user_id):
+        self.cur.execute("""
+            SELECT age, gender, city, country, interests, premium_until
+            FROM users WHERE user_id=%s
+        """, (user_id,))
+        row = self.cur.fetchone()
+        return dict(zip(PROFILE_FIELDS + ("premium_until",), row)) if row else None
+
+    def get_premium_until(self, user_id):
+        self.cur.execute("SELECT premium_until FROM users WHERE user_id=%s", (user_id,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def save_profile(self, user_id, **fields):
+        if not fields or set(fields) - set(PROFILE_FIELDS):
+            raise ValueError(f"Invalid profile fields: {sorted(fields)}")
+        columns = list(fields)
+        self.cur.execute(f"""
+            INSERT INTO users (user_id, {", ".join(columns)})
+            VALUES (%s, {", ".join(["%s"] * len(columns))})
+            ON CONFLICT (user_id) DO UPDATE
+            SET {", ".join(f"{c} = EXCLUDED.{c}" for c in columns)}
+            RETURNING {REFERRAL_CHECK_COLUMNS}
+        """, (user_id, *fields.values()))
+        return self.cur.fetchone()
+
+    def find_candidates(self, user_id, gender=None, city=None, with_interests=False):
+        conditions, params = ["user_id != %s", "banned = false", "NOT unreachable"], [user_id]
+        if gender is not None:
+            conditions.append("gender = %s")
+            params.append(gender)
+        if city is not None:
+            conditions.append("city = %s")
+            params.append(city)
+        if with_interests:
+            conditions.append("interests IS NOT NULL AND interests != ''")
+        self.cur.execute(f"""
+            SELECT user_id, report_count, reputation_score, interests FROM users
+            WHERE {" AND ".join(conditions)}
+        """, params)
+        return self.cur.fetchall()
+
+    def get_standing(self, user_ids):
+        self.cur.execute("""
+            SELECT user_id, report_count, reputation_score FROM users
+            WHERE user_id = ANY(%s) AND banned = false
+        """, (list(user_ids),))
+        return {uid: (report_count, score) for uid, report_count, score in self.cur.fetchall()}
+
+    def update_reputation(self, user_id, delta):
+        self.cur.execute(
+            "UPDATE users SET reputation_score = reputation_score + %s WHERE user_id=%s", (delta, user_id)
+        )
+
+    def decay_reputation(self):
+        self.cur.execute("UPDATE users SET reputation_score = GREATEST(0, reputation_score - 1)")
+
+    def set_last_partners(self, user1, user2):
+        self.cur.execute("""
+            UPDATE users
+            SET last_chat_user_id = CASE WHEN user_id = %s THEN %s ELSE %s END
+            WHERE user_id IN (%s, %s)
+        """, (user1, user2, user1, user1, user2))
+
+    def get_last_partner(self, user_id):
+        self.cur.execute("SELECT last_chat_user_id FROM users WHERE user_id=%s", (user_id,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def recent_partners(self, user_id, limit):
+        self.cur.execute("""
+            SELECT partner FROM (
+                (SELECT user2 AS partner, matched_at FROM matches WHERE user1 = %s
+                 ORDER BY matched_at DESC LIMIT %s)
+                UNION ALL
+                (SELECT user1, matched_at FROM matches WHERE user2 = %s
+                 ORDER BY matched_at DESC LIMIT %s)
+            ) recent
+            ORDER BY matched_at DESC LIMIT %s
+        """, (user_id, limit, user_id, limit, limit))
+        return [row[0] for row in self.cur.fetchall()]
+
+    def block_lists(self, user_id):
+        self.cur.execute("""
+            SELECT user_id, blocked_users FROM users
+            WHERE user_id = %s OR blocked_users @> ARRAY[%s]::BIGINT[]
+        """, (user_id, user_id))
+        blocked, blocked_by = [], []
+        for row_id, row_blocked in self.cur.fetchall():
+            if row_id == user_id:
+                blocked = row_blocked or []
+            else:
+                blocked_by.append(row_id)
+        return blocked, blocked_by
+
+    def add_block(self, user_id, blocked_id):
+        self.cur.execute("""
+            UPDATE users
+            SET blocked_users = array_append(COALESCE(blocked_users, '{}'), %s)
+            WHERE user_id = %s AND NOT (%s = ANY(COALESCE(blocked_users, '{}')))
+        """, (blocked_id, user_id, blocked_id))
+
+    def complete_referral(self, user_id):
+        self.cur.execute(REFERRAL_REWARD_SQL, (user_id,))
+        return self.cur.fetchone()
+
+    def extend_premium(self, user_id, days):
+        self.cur.execute("""
+            UPDATE users
+            SET premium_until = GREATEST(COALESCE(premium_until, NOW()), NOW()) + make_interval(days => %s)
+            WHERE user_id = %s
+            RETURNING premium_until
+        """, (days, user_id))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def record_payment(self, charge_id, user_id, days, payload, currency, amount):
+        # The ledger insert and the extension are one statement: a redelivered
+        # update hits the primary key and extends nothing, and a payment from
+        # an unknown user is not ledgered at all.
+        self.cur.execute("""
+            WITH payer AS (
+                SELECT user_id FROM users WHERE user_id = %s
+            ), paid AS (
+                INSERT INTO payments (telegram_payment_charge_id, user_id, days, payload, currency, total_amount)
+                SELECT %s, user_id, %s, %s, %s, %s FROM payer
+                ON CONFLICT (telegram_payment_charge_id) DO NOTHING
+                RETURNING user_id, days
+            ), extended AS (
+                UPDATE users u
+                SET premium_until = GREATEST(COALESCE(u.premium_until, NOW()), NOW()) + make_interval(days => paid.days)
+                FROM paid
+                WHERE u.user_id = paid.user_id
+                RETURNING u.premium_until
+            )
+            SELECT EXISTS (SELECT 1 FROM payer), (SELECT premium_until FROM extended)
+        """, (user_id, charge_id, days, payload, currency, amount))
+        exists, until = self.cur.fetchone()
+        if not exists:
+            raise LookupError(f"Unknown user {user_id}")
+        return until
+
+    def set_premium_until(self, user_id, until):
+        self.cur.execute("UPDATE users SET premium_until = %s WHERE user_id = %s", (until, user_id))
+
+    def set_last_seen(self, seen):
+        self._execute_values("""
+            UPDATE users SET last_seen = to_timestamp(v.seen)::TIMESTAMP
+            FROM (VALUES %s) AS v(user_id, seen)
+            WHERE users.user_id = v.user_id
+        """, list(seen.items()))
+
+    # ================= BANS =================
+
+    def load_bans(self):
+        self.cur.execute("SELECT COALESCE(MAX(id), 0) FROM ban_log")
+        watermark = self.cur.fetchone()[0]
+        self.cur.execute("SELECT user_id FROM bans")
+        return {row[0] for row in self.cur.fetchall()}, watermark
+
+    def ban_changes(self, since):
+        self.cur.execute("SELECT id, user_id, banned FROM ban_log WHERE id > %s ORDER BY id", (since,))
+        return self.cur.fetchall()
+
+    def is_banned(self, user_id):
+        self.cur.execute("SELECT 1 FROM bans WHERE user_id=%s", (user_id,))
+        return self.cur.fetchone() is not None
+
+    def ban(self, user_id, reason=""):
+        self.cur.execute("""
+            INSERT INTO bans (user_id, banned_at, reason) VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
+        """, (user_id, int(time.time()), reason))
+        return self.cur.fetchone() is not None
+
+    def unban(self, user_id):
+        self.cur.execute("DELETE FROM bans WHERE user_id = %s", (user_id,))
+
+    # ================= REPORTS =================
+
+    def add_reports(self, reports, penalty):
+        per_user = {}
+        for _, reported_id, _, _ in reports:
+            per_user[reported_id] = per_user.get(reported_id, 0) + 1
+        self._execute_values("""
+            INSERT INTO reports (reporter_id, reported_id, reason, reported_at) VALUES %s
+        """, reports)
+        self._execute_values(f"""
+            UPDATE users
+            SET report_count = COALESCE(report_count, 0) + v.n,
+                reputation_score = reputation_score - {int(penalty)} * v.n
+            FROM (VALUES %s) AS v(user_id, n)
+            WHERE users.user_id = v.user_id
+        """, list(per_user.items()))
+
+    def auto_ban(self, user_ids, window_hours, threshold):
+        # bans' trigger mirrors these into users.banned and ban_log
+        self.cur.execute("""
+            INSERT INTO bans (user_id, banned_at, reason)
+            SELECT reported_id, EXTRACT(EPOCH FROM NOW())::BIGINT, 'reports' FROM reports
+            WHERE reported_id = ANY(%s)
+              AND reported_at > NOW() - make_interval(hours => %s)
+            GROUP BY reported_id
+            HAVING COUNT(DISTINCT reporter_id) >= %s
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
+        """, (list(user_ids), window_hours, threshold))
+        return [row[0] for row in self.cur.fetchall()]
+
+    # ================= MATCHES & EVENTS =================
+
+    def add_matches(self, matches):
+        self._execute_values("""
+            INSERT INTO matches (user1, user2, matched_at, ended_at, duration, end_reason)
+            VALUES %s
+        """, matches)
+
+    def add_chat_events(self, events):
+        for ts in {_month_start(e[4]) for e in events}:
+            self._ensure_partition(ts)
+        self._execute_values("""
+            INSERT INTO chat_events (event, user_id, partner_id, duration, created_at)
+            VALUES %s
+        """, events)
+
+    # ================= COUNTERS =================
+
+    def load_counters(self, day):
+        self.cur.execute("SELECT EXISTS (SELECT 1 FROM stats_rollup)")
+        if not self.cur.fetchone()[0]:
+            self._backfill_counters()
+
+        self.cur.execute("SELECT name, SUM(value) FROM stats_rollup GROUP BY name")
+        totals = {name: int(value) for name, value in self.cur.fetchall()}
+        self.cur.execute("SELECT name, value FROM stats_rollup WHERE day = %s", (day,))
+        daily = {name: int(value) for name, value in self.cur.fetchall()}
+        self.cur.execute("SELECT user_id FROM daily_active WHERE day = %s", (day,))
+        active = {row[0] for row in self.cur.fetchall()}
+        return totals, daily, active
+
+    def _backfill_counters(self):
+        self.cur.execute("""
+            INSERT INTO stats_rollup (day, name, value)
+            SELECT %s, 'joins', COUNT(*) FROM users
+            UNION ALL SELECT %s, 'referrals', COALESCE(SUM(referral_count), 0) FROM users
+            UNION ALL SELECT %s, 'reports', COALESCE(SUM(report_count), 0) FROM users
+            ON CONFLICT (day, name) DO NOTHING
+        """, (BASELINE_DAY, BASELINE_DAY, BASELINE_DAY))
+
+    def add_counters(self, deltas, active):
+        if deltas:
+            self._execute_values("""
+                INSERT INTO stats_rollup (day, name, value) VALUES %s
+                ON CONFLICT (day, name) DO UPDATE SET value = stats_rollup.value + EXCLUDED.value
+            """, [(day, name, delta) for (day, name), delta in deltas.items()])
+        if active:
+            self._execute_values("""
+                INSERT INTO daily_active (day, user_id) VALUES %s
+                ON CONFLICT DO NOTHING
+            """, list(active))
+
+    # ================= BROADCASTS =================
+
+    def create_broadcast(self, text):
+        self.cur.execute("INSERT INTO broadcasts (text) VALUES (%s) RETURNING id", (text,))
+        return self.cur.fetchone()[0]
+
+    def active_broadcast(self):
+        self.cur.execute("""
+            SELECT id, text, last_user_id, sent, failed FROM broadcasts
+            WHERE finished_at IS NULL ORDER BY id LIMIT 1
+        """)
+        return self.cur.fetchone()
+
+    def broadcast_recipients(self, after_user_id, limit):
+        # Keyset page on the primary key: each chunk is an index range scan,
+        # and the last id doubles as the resume point.
+        self.cur.execute("""
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > %s AND NOT u.unreachable
+              AND NOT EXISTS (SELECT 1 FROM bans b WHERE b.user_id = u.user_id)
+            ORDER BY u.user_id LIMIT %s
+        """, (after_user_id, limit))
+        return [row[0] for row in self.cur.fetchall()]
+
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, finished=False):
+        self.cur.execute("""
+            UPDATE broadcasts
+            SET last_user_id = %s, sent = %s, failed = %s,
+                finished_at = CASE WHEN %s THEN NOW() ELSE finished_at END
+            WHERE id = %s
+        """, (last_user_id, sent, failed, finished, broadcast_id))
+
+    def mark_unreachable(self, user_ids):
+        self.cur.execute(
+            "UPDATE users SET unreachable = true WHERE user_id = ANY(%s)", (list(user_ids),)
+        )
+
+    def mark_reachable(self, user_ids):
+        self.cur.execute(
+            "UPDATE users SET unreachable = false WHERE user_id = ANY(%s) AND unreachable", (list(user_ids),)
+        )
+
+    def unreachable_users(self):
+        self.cur.execute("SELECT user_id FROM users WHERE unreachable")
+        return {row[0] for row in self.cur.fetchall()}
+
+    # ================= EXPORT =================
+
+    def export_rows(self, name):
+        # Own connection and a named (server-side) cursor: the table arrives
+        # EXPORT_BATCH rows at a time and the bot's connection stays free.
+        conn = psycopg2.connect(self.url)
+        try:
+            with conn.cursor(name=f"export_{name}") as cur:
+                cur.itersize = EXPORT_BATCH
+                cur.execute(f"SELECT * FROM {EXPORT_TABLES[name]}")
+                rows = cur.fetchmany(EXPORT_BATCH)
+                yield [column.name for column in cur.description]
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(EXPORT_BATCH)
+        finally:
+            conn.close()
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The bot is a flat set of modules in the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bench  # noqa: E402
+
+
+class App:
+    """main.py started once on memory:// against bench.py's fake Bot API,
+    driven with synthetic updates on one event loop."""
+
+    def __init__(self, loop, api, main):
+        self.loop = loop
+        self.api = api
+        self.main = main
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def send(self, uid, text):
+        self.run(self.main.dp.process_updates([bench.message_update(uid, text)]))
+        return self.api.last_text.get(uid)
+
+    def press(self, uid, data):
+        self.run(self.main.dp.process_updates([bench.callback_update(uid, data)]))
+        return self.api.last_text.get(uid)
+
+    def register(self, uid):
+        self.send(uid, "/start")
+        for step in ("25", "Male", "Berlin", "Germany"):
+            self.send(uid, step)
+        self.press(uid, "interests_done")
+
+
+@pytest.fixture(scope="session")
+def app():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    api = bench.FakeBotAPI()
+    loop.run_until_complete(api.start())
+    os.environ["DATABASE_URL"] = "memory://"
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ.setdefault("BOT_TOKEN", bench.BENCH_TOKEN)
+    os.environ.setdefault("ADMIN_ID", str(bench.BENCH_ADMIN_ID))
+
+    import main
+    from aiogram import Bot, Dispatcher
+    loop.run_until_complete(main.create_app())
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+
+    yield App(loop, api, main)
+
+    for task in list(main.scheduled_timers):
+        task.cancel()
+
+    async def close():
+        await (await main.bot.get_session()).close()
+        await api.stop()
+
+    loop.run_until_complete(close())
+    loop.close()
+    asyncio.set_event_loop(None)
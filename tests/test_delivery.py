@@ -0,0 +1,27 @@
+"""Unreachable flags: set on failed sends, cleared when the user comes back."""
+import asyncio
+
+from aiogram.utils.exceptions import BotBlocked
+
+import bench
+import delivery
+import storage
+
+
+def test_flag_from_earlier_run_cleared_by_any_update():
+    store = storage.MemoryStorage()
+    store.create_user(42)
+    first_run = delivery.DeliveryTracker()
+    first_run.failed(42, BotBlocked("Forbidden: bot was blocked by the user"))
+    first_run.flush(store)
+    assert store.unreachable_users() == {42}
+
+    # After a restart the user sends something other than /start
+    tracker = delivery.DeliveryTracker()
+    tracker.load(store)
+    middleware = delivery.DeliveryMiddleware(tracker)
+    asyncio.run(middleware.on_pre_process_update(bench.message_update(42, "🔍 Find Chat"), {}))
+    tracker.flush(store)
+
+    assert not tracker.is_unreachable(42)
+    assert store.unreachable_users() == set()
@@ -0,0 +1,43 @@
+"""Registration survives its state expiring halfway through."""
+
+
+def expire(state, key):
+    """Make `key` due now, as if its TTL had run out."""
+    value, _ = state.data[key]
+    state.data[key] = (value, 0)
+
+
+def test_start_resumes_expired_registration(app):
+    main = app.main
+    uid = 2_100_001
+    app.send(uid, "/start")
+    app.send(uid, "31")
+    expire(main.onboarding_state, uid)
+    assert uid not in main.onboarding_state
+
+    assert "Enter your age" in app.send(uid, "/start")
+    assert main.onboarding_state[uid] == {"step": "age"}
+
+    for step in ("31", "Female", "Lisbon", "Portugal"):
+        app.send(uid, step)
+    assert "Profile complete" in app.press(uid, "interests_done")
+    profile = main.store.get_profile(uid)
+    assert (profile["age"], profile["gender"], profile["city"]) == (31, "Female", "Lisbon")
+    assert "Welcome back" in app.send(uid, "/start")
+
+
+def test_expired_interest_edit_is_not_saved(app):
+    main = app.main
+    uid = 2_100_002
+    app.register(uid)
+    app.press(uid, "edit_interests")
+    app.press(uid, "toggle_interest:Music")
+    expire(main.interest_state, uid)
+
+    assert "expired" in app.press(uid, "interests_done")
+    assert main.store.get_profile(uid)["interests"] == ""
+    assert uid in main.interest_state  # The picker is open again
+
+    app.press(uid, "toggle_interest:Music")
+    assert "Interests updated" in app.press(uid, "interests_done")
+    assert main.store.get_profile(uid)["interests"] == "Music"
@@ -0,0 +1,51 @@
+"""Telegram Stars payments are credited exactly once, or reported."""
+import itertools
+import time
+
+from aiogram import types
+
+_ids = itertools.count(3_000_000)
+
+
+def payment_update(uid, charge_id, payload="premium_30"):
+    return types.Update.to_object({
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+            "successful_payment": {
+                "currency": "XTR", "total_amount": 100, "invoice_payload": payload,
+                "telegram_payment_charge_id": charge_id, "provider_payment_charge_id": "",
+            },
+        },
+    })
+
+
+def pay(app, uid, charge_id):
+    app.run(app.main.dp.process_updates([payment_update(uid, charge_id)]))
+    return app.api.last_text.get(uid)
+
+
+def test_payment_from_unknown_user_is_credited(app):
+    main = app.main
+    uid = 2_200_001
+    joins = main.event_counters.get("joins")[1]
+
+    assert "Premium activated" in pay(app, uid, "charge-unknown-user")
+    assert main.store.get_premium_until(uid) is not None
+    assert main.event_counters.get("joins")[1] == joins + 1
+
+
+def test_failed_payment_is_reported_with_its_charge_id(app, monkeypatch):
+    main = app.main
+    uid = 2_200_002
+    app.register(uid)
+
+    def down(*args, **kwargs):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(main.store, "record_payment", down)
+    reply = pay(app, uid, "charge-db-down")
+    assert "could not be activated" in reply and "charge-db-down" in reply
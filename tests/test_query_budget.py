@@ -0,0 +1,31 @@
+"""Query budgets for the matching hot paths, on the in-memory store.
+
+Every store call counts as one query, so a change that adds a round trip
+to find, next or connect_users fails here before it reaches Postgres.
+"""
+import querybudget
+
+FIND_BUDGET = 6     # Second find: partner lookup, both profiles, block lists, history, last partners
+NEXT_BUDGET = 8     # next: the above plus the skip's reputation updates
+CONNECT_BUDGET = 6  # Both profiles, both users' block lists and history, last partners
+
+
+def test_matching_query_budgets(app):
+    main = app.main
+    a, b, c, d, e = range(2_000_001, 2_000_006)
+    for uid in (a, b, c, d, e):
+        app.register(uid)
+
+    app.send(a, "🔍 Find Chat")
+    with querybudget.assert_max_queries(FIND_BUDGET):
+        app.send(b, "🔍 Find Chat")
+    assert main.active_chats.get(a) == b
+
+    app.send(c, "🔍 Find Chat")
+    with querybudget.assert_max_queries(NEXT_BUDGET):
+        app.send(a, "➡ Next")
+    assert main.active_chats.get(a) == c
+
+    with querybudget.assert_max_queries(CONNECT_BUDGET):
+        app.run(main.connect_users(d, e))
+    assert main.active_chats.get(d) == e
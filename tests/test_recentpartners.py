@@ -0,0 +1,24 @@
+from recentpartners import RecentPartners
+
+
+def test_flushed_matches_are_not_counted_twice():
+    history = {1: []}
+    partners = RecentPartners(3, lambda uid, limit: history.get(uid, [])[:limit])
+    partners.add(1, 10)
+    partners.add(1, 11)
+    history[1] = [11, 10, 9, 8]  # The event log flushed both matches before the first check
+
+    assert partners.contains(1, 11) and partners.contains(1, 10) and partners.contains(1, 9)
+    assert not partners.contains(1, 8)
+
+
+def test_least_recently_used_ring_is_reused():
+    partners = RecentPartners(2, lambda uid, limit: [], max_users=2)
+    partners.add(1, 2)
+    assert partners.contains(1, 2)  # 2 is now the least recently used
+    partners.add(3, 4)
+
+    assert len(partners.slots) == 2
+    assert partners.contains(3, 4) and partners.contains(4, 3)
+    assert len(partners.cursor) == 2
+    assert not partners.contains(1, 2)  # Evicted, and the loader has no history for it
@@ -0,0 +1,22 @@
+"""Cold start budget: importing main plus create_app on memory://.
+
+Measured in a fresh interpreter through bench.py, since main can only be
+imported cold once per process.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+STARTUP_BUDGET_MS = 1000  # About 150ms import plus 10ms create_app locally
+
+
+def test_cold_start_within_budget():
+    result = subprocess.run(
+        [sys.executable, "bench.py", "--users", "10", "--database-url", "memory://",
+         "--max-startup-ms", str(STARTUP_BUDGET_MS)],
+        cwd=ROOT, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert "cold start:" in result.stdout
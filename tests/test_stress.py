@@ -0,0 +1,24 @@
+"""Concurrent find/next/stop/reconnect/block updates must never leave a
+pairing inconsistent (one-sided, self-paired, or chatting while queued).
+
+Runs bench.py --stress in a fresh interpreter on memory://; the bench
+exits non-zero when pairing_errors() finds anything.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.mark.parametrize("batch_ms", [0, 50], ids=["per-request", "batch"])
+def test_concurrent_updates_keep_pairings_consistent(batch_ms):
+    result = subprocess.run(
+        [sys.executable, "bench.py", "--users", "100", "--stress", "3000", "--concurrency", "500",
+         "--batch-ms", str(batch_ms), "--database-url", "memory://"],
+        cwd=ROOT, capture_output=True, text=True, timeout=300,
+    )
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+    assert " 0 inconsistent" in result.stdout
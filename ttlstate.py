@@ -0,0 +1,77 @@
+import heapq
+import time
+
+
+class TTLState:
+    """Per-user flow state that expires `ttl` seconds after it was last set.
+
+    Used like a dict. Expired entries read as missing as soon as they are
+    due, so a router.state() check never matches an abandoned flow, and
+    sweep() drops them in O(log n) each from a heap of (expires_at, key).
+    Setting a key again pushes a new heap entry and leaves the old one to be
+    skipped, so the heap is compacted once stale entries dominate it.
+    Mutating a stored value in place does not extend its TTL; set it again.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.data = {}  # {key: (value, expires_at)}
+        self.heap = []  # [(expires_at, key)], possibly stale
+
+    def __len__(self):
+        return len(self.data)
+
+    def _entry(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def __getitem__(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        expires_at = time.monotonic() + self.ttl
+        self.data[key] = (value, expires_at)
+        heapq.heappush(self.heap, (expires_at, key))
+
+    def __delitem__(self, key):
+        if self._entry(key) is None:
+            raise KeyError(key)
+        del self.data[key]
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        return default if entry is None else entry[0]
+
+    def pop(self, key, *default):
+        entry = self._entry(key)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self.data[key]
+        return entry[0]
+
+    def sweep(self):
+        """Drop expired entries; returns how many were dropped."""
+        now = time.monotonic()
+        dropped = 0
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.heap)
+            entry = self.data.get(key)
+            # Skip entries that were set again or removed since this push
+            if entry is not None and entry[1] == expires_at:
+                del self.data[key]
+                dropped += 1
+        if len(self.heap) > 2 * len(self.data) + 64:
+            self.heap = [(expires_at, key) for key, (_, expires_at) in self.data.items()]
+            heapq.heapify(self.heap)
+        return dropped